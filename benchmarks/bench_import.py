@@ -0,0 +1,58 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+
+parser = argparse.ArgumentParser(description='Time the startup of main.py in fresh interpreters')
+parser.add_argument('--repeat', type=int, default=10, help='Interpreter launches per command')
+parser.add_argument('--top', type=int, default=15, help='Slowest modules to list from -X importtime')
+args = parser.parse_args()
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+COMMANDS = [
+        ('python -c pass', ['-c', 'pass']),
+        ('import main', ['-c', 'import main']),
+        ('main.py --help', ['main.py', '--help'])
+        ]
+
+def measure(command):
+    timings = []
+    for _ in range(args.repeat):
+        started = time.perf_counter()
+        subprocess.run([sys.executable, *command], cwd=ROOT, stdout=subprocess.DEVNULL, check=True)
+        timings.append((time.perf_counter() - started) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2], timings[0]
+
+def slowest_imports():
+    result = subprocess.run(
+            [sys.executable, '-X', 'importtime', '-c', 'import main'],
+            cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True
+            )
+    # Modules are listed after everything they import, indented by depth:
+    # the direct imports of main are the depth-one lines right before it.
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth == 0 and name.strip() == 'main':
+            break
+        if depth == 0:
+            imports = []
+        elif depth == 1:
+            imports.append((int(cumulative), name.strip()))
+    return sorted(imports, reverse=True)[:args.top]
+
+def bench():
+    for label, command in COMMANDS:
+        median, best = measure(command)
+        print(f"  {label:<16} {median:8.1f} ms  (best {best:.1f} ms)")
+    print("\nSlowest imports of main:")
+    for cumulative, name in slowest_imports():
+        print(f"  {name:<24} {cumulative / 1000:8.1f} ms")
+
+if __name__ == "__main__":
+    bench()
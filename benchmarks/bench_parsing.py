@@ -0,0 +1,86 @@
+import os
+import sys
+import time
+import glob
+import argparse
+
+from bs4 import BeautifulSoup
+
+parser = argparse.ArgumentParser(description='Compare the HTML parsing paths of main.py on saved pages')
+parser.add_argument('--fixtures', default=os.path.join(os.path.dirname(__file__), 'fixtures'),
+                    help='Directory with saved pages named letter-*.html, artist-*.html, track-*.html or lastfm-*.html')
+parser.add_argument('--repeat', type=int, default=20, help='Parses per page and backend')
+args = parser.parse_args()
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+import main
+
+def synthetic_letter_page(artists=3000):
+    rows = ''.join(
+            f'<tr><td><a href="/akkordy/artist-{i}">Artist {i}</a></td><td>{i % 40} songs</td></tr>'
+            for i in range(artists)
+            )
+    navigation = ''.join(f'<a href="?page={i}">{i}</a>' for i in range(1, 30)) + '<a href="?page=2">»</a>'
+    noise = ''.join(f'<div class="menu"><ul><li><a href="/m{i}">Menu {i}</a></li></ul></div>' for i in range(500))
+    return (
+            f'<html><head><title>A</title></head><body>{noise}'
+            f'<div class="table-responsive"><table>{rows}</table></div>'
+            f'<div class="wp-pagenavi">{navigation}</div></body></html>'
+            ).encode()
+
+def load_pages():
+    pages = []
+    for path in sorted(glob.glob(os.path.join(args.fixtures, '*.html'))):
+        kind = os.path.basename(path).split('-', 1)[0]
+        with open(path, 'rb') as page_file:
+            pages.append((os.path.basename(path), kind, page_file.read()))
+    if not pages:
+        print(f"No saved pages in {args.fixtures}, using a synthetic mytabs letter page.")
+        pages.append(('synthetic-letter', 'letter', synthetic_letter_page()))
+    return pages
+
+def full_tree(content, kind):
+    soup = BeautifulSoup(content, 'html.parser')
+    if kind == 'letter':
+        return list(main.extract_artist_links(soup, 'mytabs'))
+    return soup
+
+def strained_tree(content, kind):
+    strainer = {
+            'letter': main.LETTER_PAGE_STRAINER,
+            'artist': main.ARTIST_PAGE_STRAINER,
+            'track': main.TRACK_PAGE_STRAINER,
+            'lastfm': main.LASTFM_SIMILAR_STRAINER
+            }.get(kind)
+    soup = main.make_soup(content, strainer)
+    if kind == 'letter':
+        return list(main.extract_artist_links(soup, 'mytabs'))
+    return soup
+
+def streamed(content, kind):
+    letter_parser = main.LetterPageParser()
+    text = content.decode('utf-8', errors='replace')
+    for start in range(0, len(text), 64 * 1024):
+        letter_parser.feed(text[start:start + 64 * 1024])
+    letter_parser.close()
+    return letter_parser.get_links()
+
+def measure(function, content, kind):
+    started = time.perf_counter()
+    for _ in range(args.repeat):
+        function(content, kind)
+    return (time.perf_counter() - started) / args.repeat * 1000
+
+def bench():
+    print(f"Backend for make_soup: {main.HTML_PARSER}")
+    for name, kind, content in load_pages():
+        baseline = measure(full_tree, content, kind)
+        results = [('html.parser, full tree', baseline), (f'{main.HTML_PARSER}, strained', measure(strained_tree, content, kind))]
+        if kind == 'letter':
+            results.append(('streaming', measure(streamed, content, kind)))
+        print(f"\n{name} ({len(content) // 1024} KiB)")
+        for label, elapsed in results:
+            print(f"  {label:<28} {elapsed:8.2f} ms  x{baseline / elapsed:.1f}")
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,143 @@
+import io
+import os
+import sys
+import math
+import time
+import argparse
+import tempfile
+import contextlib
+
+parser = argparse.ArgumentParser(description='Time the main scenarios of main.py against the local stand-in')
+parser.add_argument('--latency', type=float, default=0.02, help='Seconds the stand-in adds to every response')
+parser.add_argument('--repeat', type=int, default=10, help='Runs per scenario')
+parser.add_argument('--artists', type=int, default=300, help='Size of the generated catalogue')
+parser.add_argument('--fixtures', help='Directory with recorded responses, see standin.py')
+parser.add_argument('--scenario', action='append', help='Run only scenarios whose name contains this text')
+args = parser.parse_args()
+
+sys.path.insert(0, os.path.dirname(__file__))
+from standin import StandIn, Catalogue, is_cyrillic
+
+catalogue = Catalogue(args.artists)
+stand_in = StandIn(catalogue, args.latency, args.fixtures).start()
+os.environ.update(stand_in.root_env())
+# A scratch database and working directory, so no cache, index or config
+# of a real installation is read or touched.
+workdir = tempfile.mkdtemp(prefix='scrobblethatising-bench-')
+os.environ['SCROBBLE_DB'] = os.path.join(workdir, 'bench.db')
+os.environ.setdefault('LASTFM_API_KEY', 'bench')
+os.environ['username'] = 'bench'
+os.chdir(workdir)
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import main
+main.args = main.build_parser().parse_args([])
+
+def reset(*tables):
+    with main.db_lock, main.get_db() as db:
+        for table in tables:
+            db.execute(f"DELETE FROM {table}")
+    main.api_memory_cache.clear()
+    main.artist_name_indexes.clear()
+    main.track_metadata.clear()
+    main.parse_chord_sheet.cache_clear()
+
+def pick(run, site=None):
+    # oduvanchik only lists Russian artists.
+    artists = [artist for artist in catalogue.artists if site != 'oduvanchik' or is_cyrillic(artist)]
+    artist = artists[(run * 37) % len(artists)]
+    return artist, catalogue.tracks[artist][run % len(catalogue.tracks[artist])]
+
+def chords_found(site):
+    def setup(run):
+        reset('chords_cache', 'artist_index', 'artist_index_letters', 'letter_pages')
+        return pick(run, site)
+    def scenario(artist, track):
+        assert main.get_text_and_chords(artist, track, site), f"{artist} - {track} not found on {site}"
+    return setup, scenario
+
+def chords_missing(site):
+    def setup(run):
+        reset('chords_cache', 'artist_index', 'artist_index_letters', 'letter_pages')
+        artist, track = pick(run, site)
+        return f"{artist.split()[0]} nobody", track
+    def scenario(artist, track):
+        assert not main.get_text_and_chords(artist, track, site)
+    return setup, scenario
+
+def chords_cached():
+    def setup(run):
+        artist, track = pick(run)
+        main.resolve_text_and_chords(artist, track)
+        return artist, track
+    def scenario(artist, track):
+        assert main.resolve_text_and_chords(artist, track)
+    return setup, scenario
+
+def similar_track(graph):
+    def setup(run):
+        artist, track = pick(run)
+        if graph:
+            main.search_similar_track({'name': track, 'artist': {'name': artist}})
+        else:
+            reset('api_cache', 'graph_edges')
+        return artist, track
+    def scenario(artist, track):
+        assert main.search_similar_track({'name': track, 'artist': {'name': artist}})
+    return setup, scenario
+
+def track_transition():
+    def setup(run):
+        reset('api_cache', 'graph_edges', 'chords_cache', 'artist_index', 'artist_index_letters', 'letter_pages')
+        return pick(run)
+    def scenario(artist, track):
+        assert main.prefetch_next_track({'name': track, 'artist': {'name': artist}})
+    return setup, scenario
+
+def index_build(site):
+    def setup(run):
+        reset('artist_index', 'artist_index_letters', 'letter_pages')
+        return ()
+    def scenario():
+        main.build_artist_index([site])
+    return setup, scenario
+
+SCENARIOS = [
+        *((f'chords {site} found', chords_found(site)) for site in main.CHORD_SITES),
+        *((f'chords {site} missing', chords_missing(site)) for site in main.CHORD_SITES),
+        ('chords cached', chords_cached()),
+        ('similar track via API', similar_track(graph=False)),
+        ('similar track via graph', similar_track(graph=True)),
+        ('track transition', track_transition()),
+        *((f'index build {site}', index_build(site)) for site in main.CHORD_SITES)
+        ]
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[max(math.ceil(share * len(values)) - 1, 0)]
+
+def measure(setup, scenario):
+    timings = []
+    requests = 0
+    for run in range(args.repeat):
+        with contextlib.redirect_stdout(io.StringIO()):
+            scenario_args = setup(run)
+            stand_in.take_counts()
+            started = time.perf_counter()
+            scenario(*scenario_args)
+            timings.append((time.perf_counter() - started) * 1000)
+        requests += sum(stand_in.take_counts().values())
+    return percentile(timings, 0.5), percentile(timings, 0.95), requests / args.repeat
+
+def bench():
+    print(f"Stand-in latency {args.latency * 1000:.0f} ms, {len(catalogue.artists)} artists, {args.repeat} runs each")
+    print(f"\n  {'scenario':<28} {'p50':>10} {'p95':>10} {'requests':>9}")
+    for name, (setup, scenario) in SCENARIOS:
+        if args.scenario and not any(part in name for part in args.scenario):
+            continue
+        p50, p95, requests = measure(setup, scenario)
+        print(f"  {name:<28} {p50:7.1f} ms {p95:7.1f} ms {requests:9.1f}")
+    stand_in.stop()
+
+if __name__ == "__main__":
+    bench()
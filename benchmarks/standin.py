@@ -0,0 +1,377 @@
+import os
+import sys
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+import urllib.parse
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Local stand-in for Last.fm (API and web pages), mytabs, muzbar and
+# oduvanchik. Everything is served under one port with a prefix per site;
+# point main.py at it with the *_ROOT variables printed by root_env().
+# Pages saved in the fixtures directory are served as recorded, everything
+# else comes from a generated catalogue of artists and songs.
+
+SITES = ('lastfm-api', 'lastfm', 'mytabs', 'muzbar', 'oduvanchik')
+SYLLABLES = ('ka', 'lo', 'mi', 're', 'su', 'ta', 'vo', 'ne', 'di', 'ra', 'po', 'ly', 'ga', 'be', 'zo', 'hu', 'fa', 'ni', 'wu', 'ce')
+CYRILLIC_SYLLABLES = ('ка', 'ло', 'ми', 'ре', 'су', 'та', 'во', 'не', 'ди', 'ра', 'по', 'лы', 'га', 'бе', 'зо', 'ну')
+TRANSLIT = str.maketrans('абвгдезиклмнопрстуы', 'abvgdeziklmnoprstuy')
+CHORDS = ('Am', 'C', 'Dm', 'E7', 'F', 'G', 'Em', 'A', 'D', 'Bm', 'F#m', 'H7')
+MYTABS_PAGE_SIZE = 40
+
+class Catalogue:
+    def __init__(self, artists=300, tracks=12, seed=1):
+        rng = random.Random(seed)
+        self.artists = []
+        seen = set()
+        # Every other artist is Cyrillic: oduvanchik only lists those, and
+        # mytabs files them under transliterated letters.
+        while len(self.artists) < artists:
+            syllables = CYRILLIC_SYLLABLES if len(self.artists) % 2 else SYLLABLES
+            name = ' '.join(
+                    ''.join(rng.choice(syllables) for _ in range(rng.randint(2, 3))).capitalize()
+                    for _ in range(rng.randint(1, 2))
+                    )
+            if get_slug(name) not in seen:
+                seen.add(get_slug(name))
+                self.artists.append(name)
+        self.tracks = {}
+        for artist in self.artists:
+            syllables = CYRILLIC_SYLLABLES if is_cyrillic(artist) else SYLLABLES
+            self.tracks[artist] = [
+                    f"{rng.choice(syllables).capitalize()}{rng.choice(syllables)} {rng.choice(syllables)} {number}"
+                    for number in range(1, tracks + 1)
+                    ]
+        self.slugs = {get_slug(artist): artist for artist in self.artists}
+        self.ids = {artist: number for number, artist in enumerate(self.artists, 1)}
+
+    def by_letter(self, letter):
+        return sorted(artist for artist in self.artists if artist[0].lower() == letter.lower())
+
+    def by_mytabs_letter(self, letter):
+        # mytabs: "k" lists Latin artists, "k-r" Cyrillic ones starting with к.
+        if letter.endswith('-r'):
+            return sorted(
+                    artist for artist in self.artists
+                    if is_cyrillic(artist) and artist[0].lower().translate(TRANSLIT) == letter[0]
+                    )
+        return sorted(artist for artist in self.artists if not is_cyrillic(artist) and artist[0].lower() == letter[0])
+
+    def find_artist(self, name):
+        name = ' '.join(name.lower().split())
+        return next((artist for artist in self.artists if artist.lower() == name), None)
+
+    def rng(self, *key):
+        return random.Random(hashlib.md5(repr(key).encode()).hexdigest())
+
+    def similar_tracks(self, artist, track, limit):
+        rng = self.rng('similar', artist, track)
+        result = []
+        for artist_name in rng.sample(self.artists, min(limit, len(self.artists))):
+            result.append({
+                    'name': rng.choice(self.tracks[artist_name]),
+                    'artist': {'name': artist_name},
+                    'match': round(rng.random(), 3)
+                    })
+        return sorted(result, key=lambda similar: -similar['match'])
+
+    def similar_artists(self, artist, limit):
+        rng = self.rng('artists', artist)
+        return [
+                {'name': name, 'match': round(rng.random(), 3)}
+                for name in rng.sample(self.artists, min(limit, len(self.artists)))
+                ]
+
+    def chords(self, artist, track):
+        rng = self.rng('chords', artist, track)
+        lines = []
+        for verse in range(3):
+            lines.append(f"Куплет {verse + 1}:")
+            for _ in range(4):
+                lines.append('  '.join(rng.choice(CHORDS) for _ in range(4)))
+                lines.append(' '.join(rng.choice(SYLLABLES) * 2 for _ in range(6)))
+            lines.append('')
+        return '\n'.join(lines)
+
+def is_cyrillic(name):
+    return 'а' <= name[0].lower() <= 'я'
+
+def get_slug(name):
+    return '-'.join(name.lower().translate(TRANSLIT).split())
+
+def html_page(body):
+    noise = ''.join(f'<div class="menu"><ul><li><a href="/m{i}">Menu {i}</a></li></ul></div>' for i in range(50))
+    return f'<html><head><meta charset="utf-8"><title>Stand-in</title></head><body>{noise}{body}</body></html>'
+
+class StandIn:
+    def __init__(self, catalogue=None, latency=0.0, fixtures=None):
+        self.catalogue = catalogue or Catalogue()
+        self.latency = latency
+        self.fixtures = fixtures
+        self.requests = Counter()
+        self.lock = threading.Lock()
+        self.server = None
+
+    def count(self, site):
+        with self.lock:
+            self.requests[site] += 1
+
+    def take_counts(self):
+        with self.lock:
+            counts = dict(self.requests)
+            self.requests.clear()
+        return counts
+
+    def start(self, port=0):
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # Headers and body go out in one segment; written separately they
+            # run into Nagle's algorithm and delayed ACKs on keep-alive.
+            wbufsize = -1
+
+            def do_GET(self):
+                stand_in.handle(self)
+
+            def do_POST(self):
+                length = int(self.headers.get('Content-Length') or 0)
+                self.body = self.rfile.read(length).decode()
+                stand_in.handle(self)
+
+            def log_message(self, format, *log_args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def root_env(self):
+        root = f"http://127.0.0.1:{self.server.server_address[1]}"
+        return {
+                'LASTFM_API_ROOT': f"{root}/lastfm-api/2.0/",
+                'LASTFM_WEB_ROOT': f"{root}/lastfm",
+                'MYTABS_ROOT': f"{root}/mytabs",
+                'MUZBAR_ROOT': f"{root}/muzbar",
+                'ODUVANCHIK_ROOT': f"{root}/oduvanchik"
+                }
+
+    def handle(self, request):
+        site, _, path = request.path.lstrip('/').partition('/')
+        path = '/' + path
+        if site not in SITES:
+            return self.respond(request, 404, 'Not found')
+        self.count(site)
+        if self.latency:
+            time.sleep(self.latency)
+        recorded = self.get_recorded(site, path, getattr(request, 'body', ''))
+        if recorded is not None:
+            return self.respond(request, 200, recorded, 'application/json' if site == 'lastfm-api' else 'text/html')
+        page = getattr(self, f"serve_{site.replace('-', '_')}")(path, getattr(request, 'body', ''))
+        if page is None:
+            return self.respond(request, 404, html_page('<h1>404</h1>'))
+        if isinstance(page, dict):
+            return self.respond(request, 200, json.dumps(page), 'application/json')
+        return self.respond(request, 200, page)
+
+    def respond(self, request, status, body, content_type='text/html'):
+        body = body.encode()
+        request.send_response(status)
+        request.send_header('Content-Type', f'{content_type}; charset=utf-8')
+        request.send_header('Content-Length', str(len(body)))
+        request.end_headers()
+        request.wfile.write(body)
+
+    def get_recorded(self, site, path, body):
+        # lastfm-api/<method>.json, or the quoted path of a page, e.g.
+        # mytabs/%2Fakkordy%2Fa%3Fpage%3D2.html
+        if not self.fixtures:
+            return None
+        if site == 'lastfm-api':
+            query = get_query(path, body)
+            name = f"{query.get('method', '').lower()}.json"
+        else:
+            name = urllib.parse.quote(path, safe='') + '.html'
+        fixture_path = os.path.join(self.fixtures, site, name)
+        if os.path.exists(fixture_path):
+            with open(fixture_path, encoding='utf-8') as fixture:
+                return fixture.read()
+        return None
+
+    def serve_lastfm_api(self, path, body):
+        query = get_query(path, body)
+        method = query.get('method', '').lower()
+        catalogue = self.catalogue
+        limit = int(query.get('limit', 50))
+        artist = catalogue.find_artist(query.get('artist', ''))
+        if method == 'track.search':
+            needle = query.get('track', '').lower()
+            matches = [
+                    {'name': track, 'artist': name}
+                    for name in catalogue.artists for track in catalogue.tracks[name] if needle in track.lower()
+                    ]
+            page = int(query.get('page', 1))
+            return {'results': {'trackmatches': {'track': matches[(page - 1) * limit:page * limit]}}}
+        if method == 'track.getsimilar':
+            tracks = catalogue.similar_tracks(artist, query.get('track'), limit) if artist else []
+            return {'similartracks': {'track': tracks}}
+        if method == 'track.getinfo':
+            if not artist:
+                return {'error': 6, 'message': 'Track not found'}
+            rng = catalogue.rng('info', artist, query.get('track'))
+            info = {'name': query.get('track'), 'artist': {'name': artist}, 'album': {'title': f"{artist} album"}}
+            if query.get('username'):
+                info['userplaycount'] = str(rng.randint(0, 40))
+                info['userloved'] = str(int(rng.random() < 0.2))
+            return {'track': info}
+        if method == 'artist.getsimilar':
+            return {'similarartists': {'artist': catalogue.similar_artists(artist, limit) if artist else []}}
+        if method == 'artist.gettoptracks':
+            tracks = catalogue.tracks.get(artist, [])[:limit]
+            return {'toptracks': {'track': [{'name': track, 'artist': {'name': artist}} for track in tracks]}}
+        if method == 'user.getlovedtracks':
+            loved = [(name, catalogue.tracks[name][0]) for name in catalogue.artists]
+            page = int(query.get('page', 1))
+            total_pages = max((len(loved) + limit - 1) // limit, 1)
+            tracks = [
+                    {'name': track, 'artist': {'name': name}, 'date': {'uts': str(1700000000 - index)}}
+                    for index, (name, track) in enumerate(loved)
+                    ][(page - 1) * limit:page * limit]
+            return {'lovedtracks': {'track': tracks, '@attr': {'page': str(page), 'totalPages': str(total_pages)}}}
+        return {'error': 3, 'message': 'Invalid Method - No method with that name in this package'}
+
+    def serve_lastfm(self, path, body):
+        parts = [urllib.parse.unquote(part) for part in urllib.parse.urlsplit(path).path.split('/')]
+        # /music/<artist>/_/<track> or /music/<artist>/+similar
+        if len(parts) < 4 or parts[1] != 'music':
+            return None
+        artist = self.catalogue.find_artist(parts[2])
+        if not artist:
+            return None
+        if parts[3] == '+similar':
+            items = ''.join(
+                    f'<li><h3><a href="/music/{similar["name"]}">{similar["name"]}</a></h3></li>'
+                    for similar in self.catalogue.similar_artists(artist, 20)
+                    )
+            return html_page(f'<h2>Similar Artists</h2><ol>{items}</ol>')
+        if parts[3] == '_' and len(parts) > 4:
+            items = ''.join(
+                    f'<li><h3><a href="#">{similar["name"]}</a></h3><p><span><a href="#">{similar["artist"]["name"]}</a></span></p></li>'
+                    for similar in self.catalogue.similar_tracks(artist, parts[4], 10)
+                    )
+            return html_page(f'<h3>Similar Tracks</h3><ol>{items}</ol>')
+        return None
+
+    def serve_mytabs(self, path, body):
+        url = urllib.parse.urlsplit(path)
+        parts = url.path.strip('/').split('/')
+        if parts[0] != 'akkordy' or len(parts) < 2:
+            return None
+        catalogue = self.catalogue
+        if len(parts) == 3:
+            artist = catalogue.slugs.get(parts[1])
+            track = next((track for track in catalogue.tracks.get(artist, []) if get_slug(track) == parts[2]), None)
+            return html_page(f'<pre>{catalogue.chords(artist, track)}</pre>') if track else None
+        if parts[1] in catalogue.slugs:
+            artist = catalogue.slugs[parts[1]]
+            rows = ''.join(
+                    f'<tr><td><a class="songtitle" href="/akkordy/{parts[1]}/{get_slug(track)}">{track}</a></td></tr>'
+                    for track in catalogue.tracks[artist]
+                    )
+            return html_page(f'<div class="table-responsive"><table>{rows}</table></div>')
+        artists = catalogue.by_mytabs_letter(parts[1])
+        page = int(urllib.parse.parse_qs(url.query).get('page', ['1'])[0])
+        max_page = max((len(artists) + MYTABS_PAGE_SIZE - 1) // MYTABS_PAGE_SIZE, 1)
+        rows = ''.join(
+                f'<tr><td><a href="/akkordy/{get_slug(artist)}">{artist}</a></td><td>{len(catalogue.tracks[artist])}</td></tr>'
+                for artist in artists[(page - 1) * MYTABS_PAGE_SIZE:page * MYTABS_PAGE_SIZE]
+                )
+        navigation = ''
+        if max_page > 1:
+            navigation = ''.join(f'<a href="?page={number}">{number}</a>' for number in range(1, max_page + 1))
+            navigation = f'<div class="wp-pagenavi">{navigation}<a href="?page={min(page + 1, max_page)}">»</a></div>'
+        return html_page(f'<div class="table-responsive"><table>{rows}</table></div>{navigation}')
+
+    def serve_muzbar(self, path, body):
+        url = urllib.parse.urlsplit(path)
+        parts = url.path.strip('/').split('/')
+        if parts[0] != 'tabs':
+            return None
+        catalogue = self.catalogue
+        if len(parts) == 1 or not parts[1]:
+            letter = urllib.parse.parse_qs(url.query).get('letter', [''])[0]
+            if not letter:
+                return None
+            items = ''.join(
+                    f'<div class="media"><div class="media-body"><a href="/tabs/{get_slug(artist)}/">{artist}</a></div></div>'
+                    for artist in catalogue.by_letter(letter[0])
+                    )
+            return html_page(items)
+        artist = catalogue.slugs.get(parts[1])
+        if not artist:
+            return None
+        if len(parts) == 3 and parts[2]:
+            track = next((track for track in catalogue.tracks[artist] if f"{get_slug(track)}.html" == parts[2]), None)
+            return html_page(f'<div class="chords"><pre>{catalogue.chords(artist, track)}</pre></div>') if track else None
+        rows = ''.join(
+                f'<tr><td><a href="/tabs/{parts[1]}/{get_slug(track)}.html">{track}</a></td></tr>'
+                for track in catalogue.tracks[artist]
+                )
+        return html_page(f'<table class="tabs_table">{rows}</table>')
+
+    def serve_oduvanchik(self, path, body):
+        url = urllib.parse.urlsplit(path)
+        query = urllib.parse.parse_qs(url.query)
+        page = url.path.strip('/')
+        catalogue = self.catalogue
+        if page == 'art_ltr.php':
+            letter = urllib.parse.unquote_to_bytes(url.query.partition('=')[2]).decode('cp1251')
+            rows = ''.join(
+                    f'<tr><td><a href="art.php?id={catalogue.ids[artist]}">{artist}</a></td></tr>'
+                    for artist in catalogue.by_letter(letter)
+                    )
+            return html_page(f'<div class="text"><table>{rows}</table></div>')
+        if page == 'art.php':
+            artist = catalogue.artists[int(query['id'][0]) - 1]
+            links = ''.join(
+                    f'<a href="view_song.php?id={catalogue.ids[artist]}-{number}">{track}</a><br>'
+                    for number, track in enumerate(catalogue.tracks[artist])
+                    )
+            return html_page(f'<div class="text">{links}</div>')
+        if page == 'view_song.php':
+            artist_id, _, number = query['id'][0].partition('-')
+            artist = catalogue.artists[int(artist_id) - 1]
+            return html_page(f'<pre>{catalogue.chords(artist, catalogue.tracks[artist][int(number)])}</pre>')
+        return None
+
+def get_query(path, body):
+    query = dict(urllib.parse.parse_qsl(urllib.parse.urlsplit(path).query))
+    query.update(urllib.parse.parse_qsl(body))
+    return query
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Serve a local stand-in for Last.fm and the chord sites')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every response')
+    parser.add_argument('--fixtures', help='Directory with recorded responses, one subdirectory per site')
+    parser.add_argument('--artists', type=int, default=300, help='Size of the generated catalogue')
+    args = parser.parse_args()
+
+    stand_in = StandIn(Catalogue(args.artists), args.latency, args.fixtures).start(args.port)
+    print("Serving the stand-in; run main.py with:")
+    for name, value in stand_in.root_env().items():
+        print(f"{name}={value}")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        stand_in.stop()
+        sys.exit(0)
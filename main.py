@@ -1,66 +1,543 @@
 import os
+import re
 import sys
 import signal
-import argparse
-import requests
-import configparser
 import time
 import hashlib
-import pylast
 import json
 import random
 import threading
+import queue
 import urllib.parse
 import unicodedata
-import pydoc
+import codecs
+import functools
+import contextlib
+import importlib.util
 
-from bs4 import BeautifulSoup
 from dotenv import load_dotenv
-from collections import OrderedDict
-from transliterate import translit
+from collections import OrderedDict, Counter
+from html.parser import HTMLParser
+from concurrent.futures import ThreadPoolExecutor, as_completed, TimeoutError as FutureTimeoutError
 
+# requests, pylast, bs4, transliterate, pydoc and friends are
+# imported by the functions that use them, so --help or a run served from
+# the caches does not pay for loading them.
+HTML_PARSER = "lxml" if importlib.util.find_spec("lxml") else "html.parser"
+
+# Module constants below read the environment, so .env is loaded first.
 load_dotenv()
 api_key = os.getenv("LASTFM_API_KEY")
 api_secret = os.getenv("LASTFM_API_SECRET")
 username = os.getenv("username")
 password = os.getenv("password")
 
-parser = argparse.ArgumentParser(description='Last.fm audio player')
-parser.add_argument('-n', '--track', metavar='TRACK', help='Search by track')
-# parser.add_argument('-b', '--album', metavar='ALBUM', help='Search by album')
-# parser.add_argument('-a', '--artist', metavar='ARTIST', help='Search by artist')
-# parser.add_argument('-g', '--tag', metavar='TAG', help='Search by tag')
-# parser.add_argument('-u', '--user', metavar='USER', help='Search by user')
-args = parser.parse_args()
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "15"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "3"))
+HTTP_BACKOFF = float(os.getenv("HTTP_BACKOFF", "0.5"))
+HTTP_POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", "10"))
+HTTP_RETRY_STATUSES = (429, 500, 502, 503, 504)
+NOW_PLAYING_TTL = int(os.getenv("NOW_PLAYING_TTL", "300"))
+NOW_PLAYING_MARGIN = int(os.getenv("NOW_PLAYING_MARGIN", "30"))
+DB_PATH = os.getenv("SCROBBLE_DB", "scrobblethatising.db")
+SCROBBLE_BATCH_SIZE = 50
+SCROBBLE_FLUSH_INTERVAL = int(os.getenv("SCROBBLE_FLUSH_INTERVAL", "60"))
+SCROBBLE_MAX_ATTEMPTS = int(os.getenv("SCROBBLE_MAX_ATTEMPTS", "5"))
+CHORDS_CACHE_TTL = int(os.getenv("CHORDS_CACHE_TTL", str(30 * 24 * 3600)))
+CHORDS_MISS_TTL = int(os.getenv("CHORDS_MISS_TTL", str(24 * 3600)))
+CHORDS_CACHE_SIZE = int(os.getenv("CHORDS_CACHE_SIZE", "2000"))
+CHORD_SHEET_CACHE_SIZE = 64
+CHORD_SITES = ("mytabs", "muzbar", "oduvanchik")
+INDEX_ALPHABET = "abcdefghijklmnopqrstuvwxyzабвгдежзийклмнопрстуфхцчшщэюя0"
+INDEX_MAX_AGE = int(os.getenv("INDEX_MAX_AGE", str(7 * 24 * 3600)))
+INDEX_WORKERS = int(os.getenv("INDEX_WORKERS", "4"))
+CHORDS_SOURCE_DEADLINE = float(os.getenv("CHORDS_SOURCE_DEADLINE", "20"))
+HOST_CONCURRENCY = int(os.getenv("HOST_CONCURRENCY", "4"))
+SETLIST_WORKERS = int(os.getenv("SETLIST_WORKERS", "8"))
+MATCH_THRESHOLD = float(os.getenv("MATCH_THRESHOLD", "0.75"))
+API_ROOT = os.getenv("LASTFM_API_ROOT", "http://ws.audioscrobbler.com/2.0/")
+LASTFM_WEB_ROOT = os.getenv("LASTFM_WEB_ROOT", "https://www.last.fm")
+SITE_ROOTS = {
+        "mytabs": os.getenv("MYTABS_ROOT", "https://mytabs.ru"),
+        "muzbar": os.getenv("MUZBAR_ROOT", "https://www.muzbar.ru"),
+        "oduvanchik": os.getenv("ODUVANCHIK_ROOT", "https://www.oduvanchik.net")
+        }
+API_CACHE_TTLS = {
+        "track.getsimilar": 7 * 24 * 3600,
+        "artist.getsimilar": 7 * 24 * 3600,
+        "artist.gettoptracks": 3 * 24 * 3600
+        }
+API_CACHE_MEMORY_SIZE = int(os.getenv("API_CACHE_MEMORY_SIZE", "512"))
+TRACK_METADATA_SIZE = int(os.getenv("TRACK_METADATA_SIZE", "256"))
+SIMILAR_ARTIST_WORKERS = int(os.getenv("SIMILAR_ARTIST_WORKERS", "6"))
+LASTFM_RATE = float(os.getenv("LASTFM_RATE", "5"))
+LASTFM_BURST = int(os.getenv("LASTFM_BURST", "20"))
+LASTFM_CONCURRENCY = int(os.getenv("LASTFM_CONCURRENCY", "8"))
+HISTORY_DAYS = int(os.getenv("HISTORY_DAYS", "30"))
+HISTORY_LIMIT = int(os.getenv("HISTORY_LIMIT", "5000"))
+SIMILARITY_GRAPH = os.getenv("SIMILARITY_GRAPH", "1") != "0"
+GRAPH_MAX_AGE = int(os.getenv("GRAPH_MAX_AGE", str(30 * 24 * 3600)))
+GRAPH_WALKS = 32
+GRAPH_WALK_LENGTH = 4
+GRAPH_ARTIST_HOP = 0.1
+GRAPH_PLAYED_DAMPING = 0.2
+LIBRARY_PAGE_SIZE = 200
+LIBRARY_MAX_AGE = int(os.getenv("LIBRARY_MAX_AGE", str(24 * 3600)))
+
+def build_parser():
+    import argparse
+    parser = argparse.ArgumentParser(description='Last.fm audio player')
+    parser.add_argument('-n', '--track', metavar='TRACK', help='Search by track')
+    parser.add_argument('-r', '--refresh', action='store_true', help='Ignore cached chords and scrape them again')
+    parser.add_argument('--build-index', nargs='*', choices=CHORD_SITES, help='Crawl the artist index of the chord sites (all by default) and exit')
+    parser.add_argument('--sync-library', nargs='?', const='incremental', choices=['incremental', 'full'], help='Download your loved tracks into the local library and exit')
+    parser.add_argument('--resolve-setlist', metavar='FILE', help='Find chords for every "artist - track" line of FILE and exit')
+    parser.add_argument('--trace', action='store_true', help='Print where the time went in every track transition on exit')
+    parser.add_argument('--trace-json', metavar='FILE', help='Write every traced request and parse step to FILE as JSON on exit')
+    parser.add_argument('--trace-metrics', metavar='FILE', help='Write traced totals to FILE in the OpenMetrics text format on exit')
+    parser.add_argument('-o', '--output', metavar='PATH', default='setlist', help='Directory or .zip archive for --resolve-setlist (default: setlist)')
+    # parser.add_argument('-b', '--album', metavar='ALBUM', help='Search by album')
+    # parser.add_argument('-a', '--artist', metavar='ARTIST', help='Search by artist')
+    # parser.add_argument('-g', '--tag', metavar='TAG', help='Search by tag')
+    # parser.add_argument('-u', '--user', metavar='USER', help='Search by user')
+    return parser
+
+args = None
+
+FINISHING_COMMANDS = ('q', 'p', 'n', 'qs', 'ps')
+
+class PlayerState:
+    # Everything the input listener and play_track share. The listener only
+    # posts raw commands; play_track is the only one that changes the state.
+    def __init__(self):
+        self.commands = queue.Queue()
+        self.new_track = False
+        self.next_searched = False
+        self.tonality = 0
+        self.capo = 0
+        self.chords_only = False
 
 played_tracks = OrderedDict()
 aborted_artists = OrderedDict()
-track_finished = False
-track_passed = False
-artist_aborted = False
-next_searched = False
-new_track = False
-chords_modified = False
-tonality = 0
+player = PlayerState()
 
 def signal_handler(sig, frame):
     print("\nExiting...")
+    print_api_cache_stats()
     sys.exit(0)
 
-signal.signal(signal.SIGINT, signal_handler)
+http_session = None
+http_session_lock = threading.Lock()
+
+def get_http_session():
+    # One session for the whole process: urllib3 keeps a keep-alive pool per
+    # host (ws.audioscrobbler.com, last.fm, mytabs.ru, muzbar.ru, oduvanchik.net),
+    # so consecutive requests to the same site reuse the TCP+TLS connection.
+    global http_session
+    with http_session_lock:
+        if http_session is None:
+            import requests
+            from requests.adapters import HTTPAdapter
+            from urllib3.util.retry import Retry
+            retry = Retry(
+                    total=HTTP_RETRIES,
+                    backoff_factor=HTTP_BACKOFF,
+                    status_forcelist=HTTP_RETRY_STATUSES,
+                    allowed_methods=None,
+                    respect_retry_after_header=True,
+                    raise_on_status=False
+                    )
+            adapter = HTTPAdapter(pool_connections=8, pool_maxsize=HTTP_POOL_SIZE, max_retries=retry)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            session.headers.update({"Accept-Encoding": "gzip, deflate"})
+            http_session = session
+    return http_session
+
+host_semaphores = {}
+
+def get_host_semaphore(url):
+    # At most HOST_CONCURRENCY requests in flight per site, however many
+    # lookups run in parallel.
+    host = urllib.parse.urlsplit(url).netloc
+    with http_session_lock:
+        if host not in host_semaphores:
+            host_semaphores[host] = threading.BoundedSemaphore(HOST_CONCURRENCY)
+        return host_semaphores[host]
+
+def http_get(url, **kwargs):
+    kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    with get_host_semaphore(url), trace_request("GET", url, kwargs.get("stream")) as span:
+        span['response'] = get_http_session().get(url, **kwargs)
+        return span['response']
+
+def http_post(url, **kwargs):
+    kwargs.setdefault("timeout", (HTTP_CONNECT_TIMEOUT, HTTP_READ_TIMEOUT))
+    with get_host_semaphore(url), trace_request("POST", url) as span:
+        span['response'] = get_http_session().post(url, **kwargs)
+        return span['response']
+
+class Transition:
+    # Everything traced between finishing one track and showing the next:
+    # the foreground work plus the prefetch that ran while it was playing.
+    def __init__(self, name):
+        self.name = name
+        self.started = time.time()
+        self.spans = []
+
+trace_enabled = False
+trace_lock = threading.Lock()
+trace_transitions = []
+current_transition = None
+tracing = threading.local()
+
+def new_transition(name):
+    transition = Transition(name)
+    if trace_enabled:
+        with trace_lock:
+            trace_transitions.append(transition)
+    return transition
+
+def begin_transition(transition):
+    global current_transition
+    current_transition = transition
+
+def record_span(kind, name, elapsed, **fields):
+    if not trace_enabled:
+        return
+    transition = getattr(tracing, 'transition', None) or current_transition
+    if transition is None:
+        return
+    span = {'kind': kind, 'name': name, 'elapsed': elapsed, 'background': getattr(tracing, 'background', False), **fields}
+    with trace_lock:
+        transition.spans.append(span)
+
+@contextlib.contextmanager
+def trace_span(kind, name, **fields):
+    # The caller can add fields (cache hit or miss, bytes, ...) to the
+    # yielded dict before the span is recorded.
+    started = time.perf_counter()
+    try:
+        yield fields
+    finally:
+        record_span(kind, name, time.perf_counter() - started, **fields)
+
+@contextlib.contextmanager
+def trace_request(method, url, stream=False):
+    started = time.perf_counter()
+    span = {}
+    try:
+        yield span
+    finally:
+        response = span.get('response')
+        fields = {'host': urllib.parse.urlsplit(url).netloc, 'method': method, 'path': urllib.parse.urlsplit(url).path}
+        if response is not None:
+            retries = getattr(getattr(response.raw, 'retries', None), 'history', None) or ()
+            length = response.headers.get('content-length')
+            fields['status'] = response.status_code
+            fields['retries'] = len(retries)
+            # A streamed body is only counted by the parser that reads it.
+            fields['bytes'] = int(length) if stream and length else (None if stream else len(response.content))
+        else:
+            fields['status'] = 'error'
+        record_span('http', fields['host'], time.perf_counter() - started, **fields)
+
+lastfm_network = None
+cached_session_key = None
+rejected_session_key = None
+network_lock = threading.Lock()
+# pylast.STATUS_AUTH_FAILED, STATUS_INVALID_SK, STATUS_TOKEN_UNAUTHORIZED, STATUS_TOKEN_EXPIRED
+AUTH_ERROR_CODES = (4, 9, 14, 15)
+# pylast.STATUS_OPERATION_FAILED, STATUS_OFFLINE, STATUS_TEMPORARILY_UNAVAILABLE, STATUS_RATE_LIMIT_EXCEEDED
+RETRYABLE_ERROR_CODES = (8, 11, 16, 29)
+
+def request_errors():
+    # For except clauses: requests is only imported once a request is sent,
+    # and nothing can raise its errors before that. Both helpers return
+    # tuples, since except clauses don't accept nested ones; combine with +.
+    requests = sys.modules.get("requests")
+    return (requests.RequestException,) if requests else ()
+
+def pylast_error(name):
+    pylast = sys.modules.get("pylast")
+    return (getattr(pylast, name),) if pylast else ()
+
+console = threading.local()
+
+def echo(*values, **kwargs):
+    # print() for code that may run in a background prefetch, which has to
+    # stay silent while the pager or the input prompt owns the terminal.
+    if not getattr(console, 'quiet', False):
+        print(*values, **kwargs)
+
+background_messages = queue.Queue()
+
+def echo_later(*values):
+    # For the scrobble flusher and the now-playing timer, which run while
+    # the pager or the input prompt owns the terminal: play_track prints
+    # their messages between tracks.
+    background_messages.put(' '.join(str(value) for value in values))
+
+def print_background_messages():
+    messages = Counter()
+    while True:
+        try:
+            messages[background_messages.get_nowait()] += 1
+        except queue.Empty:
+            break
+    for message, count in messages.items():
+        print(message if count == 1 else f"{message} (x{count})")
+
+def summarize_spans(spans):
+    totals = OrderedDict()
+    for span in spans:
+        label = f"{span['name']} (prefetch)" if span['background'] else span['name']
+        total = totals.setdefault(
+                (span['kind'], label), {'count': 0, 'elapsed': 0.0, 'bytes': 0, 'retries': 0, 'pages': 0, 'hit': 0, 'negative': 0, 'miss': 0}
+                )
+        total['count'] += 1
+        total['elapsed'] += span['elapsed']
+        total['bytes'] += span.get('bytes') or 0
+        total['retries'] += span.get('retries', 0)
+        total['pages'] += span.get('pages', 0)
+        if span.get('cache'):
+            total[span['cache']] += 1
+    return totals
+
+def print_trace_report():
+    for transition in trace_transitions:
+        if not transition.spans:
+            continue
+        http_spans = [span for span in transition.spans if span['kind'] == 'http']
+        received = sum(span.get('bytes') or 0 for span in http_spans)
+        print(f"\n{transition.name}: {len(http_spans)} requests, {received / 1024:.1f} KiB")
+        for (kind, label), total in summarize_spans(transition.spans).items():
+            line = f"  {kind:<12} {label:<36} {total['count']:4}x {total['elapsed'] * 1000:9.1f} ms"
+            if total['bytes']:
+                line += f" {total['bytes'] / 1024:8.1f} KiB"
+            if total['pages']:
+                line += f"  pages crawled: {total['pages']}"
+            if total['hit'] or total['negative'] or total['miss']:
+                line += f"  cache {total['hit']} hit / {total['miss']} miss"
+                if total['negative']:
+                    line += f" / {total['negative']} cached miss"
+            if total['retries']:
+                line += f"  {total['retries']} retries"
+            print(line)
+
+def write_trace_json(path):
+    transitions = [
+            {'name': transition.name, 'started': transition.started, 'spans': transition.spans}
+            for transition in trace_transitions
+            ]
+    with open(path, 'w', encoding='utf-8') as trace_file:
+        json.dump(transitions, trace_file, ensure_ascii=False, indent=1)
+
+def escape_metric_label(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def write_trace_metrics(path):
+    metrics = {}
+    def add(metric, value, **labels):
+        key = (metric, tuple(sorted(labels.items())))
+        metrics[key] = metrics.get(key, 0) + value
+    for transition in trace_transitions:
+        for span in transition.spans:
+            if span['kind'] == 'http':
+                add('scrobblethatising_http_requests', 1, host=span['host'], method=span['method'], status=str(span['status']))
+                add('scrobblethatising_http_request_seconds', span['elapsed'], host=span['host'], method=span['method'])
+                add('scrobblethatising_http_response_bytes', span.get('bytes') or 0, host=span['host'])
+                add('scrobblethatising_http_retries', span.get('retries', 0), host=span['host'])
+                continue
+            add('scrobblethatising_spans', 1, kind=span['kind'], name=span['name'])
+            add('scrobblethatising_span_seconds', span['elapsed'], kind=span['kind'], name=span['name'])
+            if span.get('cache'):
+                add('scrobblethatising_cache_lookups', 1, kind=span['kind'], name=span['name'], result=span['cache'])
+    with open(path, 'w', encoding='utf-8') as metrics_file:
+        for name in sorted({metric for metric, _ in metrics}):
+            metrics_file.write(f"# TYPE {name} counter\n")
+            for (metric, labels), value in sorted(metrics.items()):
+                if metric != name:
+                    continue
+                label_text = ','.join(f'{label}="{escape_metric_label(label_value)}"' for label, label_value in labels)
+                metrics_file.write(f"{name}_total{{{label_text}}} {value}\n")
+        metrics_file.write("# EOF\n")
+
+def report_trace():
+    if args.trace:
+        print_trace_report()
+    if args.trace_json:
+        write_trace_json(args.trace_json)
+    if args.trace_metrics:
+        write_trace_metrics(args.trace_metrics)
+
+def with_console(fn):
+    # Carries the quiet flag and the traced transition of the calling thread
+    # over to a pool thread.
+    quiet = getattr(console, 'quiet', False)
+    transition = getattr(tracing, 'transition', None)
+    background = getattr(tracing, 'background', False)
+    def run(*fn_args):
+        console.quiet = quiet
+        tracing.transition = transition
+        tracing.background = background
+        return fn(*fn_args)
+    return run
+
+def submit_with_console(executor, fn, *fn_args):
+    return executor.submit(with_console(fn), *fn_args)
+
+def get_network(interactive=True):
+    # Background threads pass interactive=False: they must never prompt for
+    # authorization while the input listener owns the terminal.
+    global lastfm_network
+    with network_lock:
+        if lastfm_network is None:
+            session_key = get_or_generate_session_key(interactive)
+            if not session_key:
+                return None
+            import pylast
+            lastfm_network = pylast.LastFMNetwork(api_key=api_key, api_secret=api_secret, session_key=session_key)
+            lastfm_network.enable_rate_limit()
+    return lastfm_network
+
+def invalidate_session():
+    # Called from background threads, which can't prompt: the rejected key
+    # is only forgotten here, and play_track authorizes again between tracks.
+    global lastfm_network, cached_session_key, rejected_session_key
+    with network_lock:
+        if cached_session_key:
+            rejected_session_key = cached_session_key
+        lastfm_network = None
+        cached_session_key = None
+
+def get_error_code(error):
+    try:
+        return int(error.get_id())
+    except (TypeError, ValueError):
+        return None
 
-def get_network():
-    session_key = get_or_generate_session_key()
-    network = pylast.LastFMNetwork(api_key=api_key, api_secret=api_secret, session_key=session_key)
-    return network
+def is_auth_error(error):
+    return get_error_code(error) in AUTH_ERROR_CODES
+
+def is_retryable_error(error):
+    # pylast reports HTTP 5xx answers of Last.fm as WSError with the HTTP
+    # status as its code.
+    code = get_error_code(error)
+    return code in RETRYABLE_ERROR_CODES or code is not None and 500 <= code < 600
+
+DB_SCHEMA = """
+CREATE TABLE IF NOT EXISTS scrobbles (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    artist TEXT NOT NULL,
+    track TEXT NOT NULL,
+    album TEXT,
+    timestamp INTEGER NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    submitted_at INTEGER
+);
+CREATE INDEX IF NOT EXISTS scrobbles_pending ON scrobbles (submitted_at, id);
+CREATE TABLE IF NOT EXISTS chords_cache (
+    artist TEXT NOT NULL,
+    track TEXT NOT NULL,
+    site TEXT NOT NULL,
+    text TEXT,
+    artist_url TEXT,
+    track_url TEXT,
+    fetched_at REAL NOT NULL,
+    accessed_at REAL NOT NULL,
+    PRIMARY KEY (artist, track, site)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS chords_cache_lru ON chords_cache (accessed_at);
+CREATE TABLE IF NOT EXISTS artist_index (
+    site TEXT NOT NULL,
+    name TEXT NOT NULL,
+    letter TEXT NOT NULL,
+    href TEXT NOT NULL,
+    PRIMARY KEY (site, name)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS artist_index_letter ON artist_index (site, letter);
+CREATE TABLE IF NOT EXISTS api_cache (
+    key TEXT PRIMARY KEY,
+    body TEXT NOT NULL,
+    expires_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS api_cache_expiry ON api_cache (expires_at);
+CREATE TABLE IF NOT EXISTS history (
+    key TEXT PRIMARY KEY,
+    artist TEXT NOT NULL,
+    track TEXT NOT NULL,
+    seq INTEGER NOT NULL,
+    played_at REAL NOT NULL,
+    scrobbled INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS history_seq ON history (played_at, seq);
+CREATE TABLE IF NOT EXISTS graph_edges (
+    source TEXT NOT NULL,
+    target TEXT NOT NULL,
+    artist TEXT NOT NULL,
+    track TEXT,
+    weight REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    PRIMARY KEY (source, target)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS loved_tracks (
+    key TEXT PRIMARY KEY,
+    artist TEXT NOT NULL,
+    track TEXT NOT NULL,
+    loved_at INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS library_sync (
+    user TEXT PRIMARY KEY,
+    synced_at REAL NOT NULL,
+    newest INTEGER NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS aborted_artists (
+    artist TEXT PRIMARY KEY,
+    count INTEGER NOT NULL,
+    aborted_at REAL NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS artist_index_letters (
+    site TEXT NOT NULL,
+    letter TEXT NOT NULL,
+    pages INTEGER NOT NULL,
+    built_at REAL NOT NULL,
+    PRIMARY KEY (site, letter)
+) WITHOUT ROWID;
+
+CREATE TABLE IF NOT EXISTS letter_pages (
+    site TEXT NOT NULL,
+    letter TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    first_name TEXT NOT NULL,
+    last_name TEXT NOT NULL,
+    pages INTEGER NOT NULL,
+    fetched_at REAL NOT NULL,
+    PRIMARY KEY (site, letter, page)
+) WITHOUT ROWID;
+"""
+
+db_connection = None
+db_lock = threading.RLock()
+
+def get_db():
+    global db_connection
+    with db_lock:
+        if db_connection is None:
+            import sqlite3
+            connection = sqlite3.connect(DB_PATH, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.executescript(DB_SCHEMA)
+            db_connection = connection
+    return db_connection
 
 def search_track(query):
-    global new_track, next_searched
     total_tracks = []
     current_page = 1
     current_index = 0
     while True:
-        url = "http://ws.audioscrobbler.com/2.0/?method=track.search"
         params = {
                 "api_key": api_key,
                 "track": query,
@@ -69,7 +546,7 @@ def search_track(query):
                 "format": "json"
                 }
         print("\nSearching track... ")
-        response = requests.get(url, params=params).json()
+        response = lastfm_get("track.search", params)
         tracks = response['results']['trackmatches']['track']
         if not tracks:
             print("No more tracks found.")
@@ -83,8 +560,8 @@ def search_track(query):
                         'album': albumname
                         }
                     }
-            new_track = True
-            next_searched = True
+            player.new_track = True
+            player.next_searched = True
             return data['track']
 
         total_tracks += tracks
@@ -146,29 +623,73 @@ def search_track(query):
 #     print("OK")
 #     return tag
 
+history_seq_bounds = [0, 0]
+
+def track_key(artist, track):
+    return f"{normalize_name(str(artist))} - {normalize_name(str(track))}"
+
+def artist_key(artist):
+    return normalize_name(str(artist))
+
+def is_played(artist, track):
+    return track_key(artist, track) in played_tracks
+
+def is_aborted(artist):
+    return artist_key(artist) in aborted_artists
+
+def load_history():
+    since = time.time() - HISTORY_DAYS * 24 * 3600
+    with db_lock:
+        db = get_db()
+        rows = db.execute(
+                "SELECT key, artist, track, seq FROM"
+                " (SELECT * FROM history WHERE played_at >= ? ORDER BY played_at DESC LIMIT ?)"
+                " ORDER BY seq",
+                (since, HISTORY_LIMIT)
+                ).fetchall()
+        for key, artist, track, seq in rows:
+            played_tracks[key] = (artist, track)
+        bounds = db.execute("SELECT MIN(seq), MAX(seq) FROM history").fetchone()
+        if bounds[0] is not None:
+            history_seq_bounds[:] = bounds
+        for artist, count in db.execute("SELECT artist, count FROM aborted_artists WHERE aborted_at >= ?", (since,)):
+            aborted_artists[artist] = count
+
 def add_to_played_tracks(artist, track, scrobbled):
-    key = f"{artist} - {track}"
-    if artist and track:
-        key = key.lower()
-    # print("before: ", played_tracks)
-    if len(played_tracks) < 1:
-        played_tracks[key] = 1
-        return
-    if key in played_tracks:
-        played_tracks.pop(key)
-        played_tracks[key] = 1
-    else:
-        played_tracks[key] = 1
-    if not scrobbled:
-        played_tracks.move_to_end(key, last=False)
-    # print("after: ", played_tracks)
+    # main() adds a (None, None) placeholder before a random start; it only
+    # lives in memory and is never written to the history table.
+    key = track_key(artist, track)
+    with db_lock:
+        played_tracks.pop(key, None)
+        played_tracks[key] = (str(artist), str(track))
+        if scrobbled:
+            history_seq_bounds[1] += 1
+            seq = history_seq_bounds[1]
+        else:
+            played_tracks.move_to_end(key, last=False)
+            history_seq_bounds[0] -= 1
+            seq = history_seq_bounds[0]
+        while len(played_tracks) > HISTORY_LIMIT:
+            played_tracks.popitem(last=False)
+        if artist and track:
+            with get_db() as db:
+                db.execute(
+                        "INSERT OR REPLACE INTO history VALUES (?, ?, ?, ?, ?, ?)",
+                        (key, artist, track, seq, time.time(), int(scrobbled))
+                        )
+
+def add_to_aborted_artists(artist):
+    key = artist_key(artist)
+    with db_lock, get_db() as db:
+        aborted_artists[key] = aborted_artists.get(key, 0) + 1
+        db.execute(
+                "INSERT OR REPLACE INTO aborted_artists VALUES (?, ?, ?)", (key, aborted_artists[key], time.time())
+                )
 
 def get_previous_track():
     if len(played_tracks):
-        keys = list(played_tracks.keys())
-        previous_key = keys[-1]
-        previous_value = played_tracks[previous_key]
-        artist, track = previous_key.split(" - ", 1)
+        previous_key = next(reversed(played_tracks))
+        artist, track = played_tracks[previous_key]
 
         data = {
                 'name': track,
@@ -179,24 +700,233 @@ def get_previous_track():
     else:
         return None
 
+api_memory_cache = OrderedDict()
+api_cache_stats = {}
+
+def get_api_cache_key(method, params):
+    items = sorted(
+            (name, str(value).strip().lower())
+            for name, value in params.items() if name not in ("api_key", "format")
+            )
+    return f"{method}?{urllib.parse.urlencode(items)}"
+
+def count_api_cache(method, outcome):
+    with db_lock:
+        stats = api_cache_stats.setdefault(method, {'hit': 0, 'miss': 0})
+        stats[outcome] += 1
+
+def get_cached_response(key):
+    now = time.time()
+    with db_lock:
+        if key in api_memory_cache:
+            expires_at, response = api_memory_cache[key]
+            if expires_at > now:
+                api_memory_cache.move_to_end(key)
+                return response
+            del api_memory_cache[key]
+        row = get_db().execute("SELECT body, expires_at FROM api_cache WHERE key = ?", (key,)).fetchone()
+        if not row or row[1] <= now:
+            return None
+        response = json.loads(row[0])
+        remember_response(key, response, row[1])
+        return response
+
+def remember_response(key, response, expires_at):
+    api_memory_cache[key] = (expires_at, response)
+    api_memory_cache.move_to_end(key)
+    while len(api_memory_cache) > API_CACHE_MEMORY_SIZE:
+        api_memory_cache.popitem(last=False)
+
+def store_response(key, response, ttl):
+    now = time.time()
+    with db_lock, get_db() as db:
+        remember_response(key, response, now + ttl)
+        db.execute("INSERT OR REPLACE INTO api_cache VALUES (?, ?, ?)", (key, json.dumps(response), now + ttl))
+        db.execute("DELETE FROM api_cache WHERE expires_at <= ?", (now,))
+
+def lookup_api_cache(method, params, ttl):
+    if ttl <= 0:
+        return None, None
+    key = get_api_cache_key(method, params)
+    cached = get_cached_response(key)
+    count_api_cache(method, 'miss' if cached is None else 'hit')
+    return key, cached
+
+def request_lastfm(method, params):
+    request_params = {"api_key": api_key, "format": "json", **params, "method": method}
+    return http_get(API_ROOT, params=request_params).json()
+
+def lastfm_get(method, params, ttl=None):
+    method = method.lower()
+    if ttl is None:
+        ttl = API_CACHE_TTLS.get(method, 0)
+    with trace_span('lastfm', method) as span:
+        key, cached = lookup_api_cache(method, params, ttl)
+        span['cache'] = 'hit' if cached is not None else 'miss'
+        if cached is not None:
+            return cached
+        api_rate_limiter.wait()
+        response = request_lastfm(method, params)
+        if key and 'error' not in response:
+            store_response(key, response, ttl)
+        return response
+
+class RateLimiter:
+    # Token bucket shared by every Last.fm API call, whatever thread makes
+    # it: bursts of up to `burst` requests, `rate` requests per second on
+    # average.
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            return max(-self.tokens / self.rate, 0)
+
+    def wait(self):
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+api_rate_limiter = RateLimiter(LASTFM_RATE, LASTFM_BURST)
+
+def sign_params(params, secret):
+    signed = ''.join(f"{name}{params[name]}" for name in sorted(params) if name not in ("format", "callback"))
+    return hashlib.md5(f"{signed}{secret}".encode()).hexdigest()
+
+def print_api_cache_stats():
+    for method, stats in sorted(api_cache_stats.items()):
+        print(f"{method}: {stats['hit']} cached, {stats['miss']} requested")
+
 def scrobble_track(artist, track, album):
-    network = get_network()
-    try:
-        network.scrobble(artist=artist, title=track, album=album, timestamp=int(time.time()))
-    except pylast.WSError as e:
-        print(f"Ошибка: {e}")
-        return None
+    with db_lock, get_db() as db:
+        db.execute(
+                "INSERT INTO scrobbles (artist, track, album, timestamp) VALUES (?, ?, ?, ?)",
+                (artist, track, album, int(time.time()))
+                )
+    forget_track_metadata(artist, track)
+    start_scrobble_flusher()
+    scrobble_wakeup.set()
     return "Success"
 
+def get_pending_scrobbles():
+    with db_lock:
+        return get_db().execute(
+                "SELECT id, artist, track, album, timestamp FROM scrobbles"
+                " WHERE submitted_at IS NULL AND attempts < ? ORDER BY id LIMIT ?",
+                (SCROBBLE_MAX_ATTEMPTS, SCROBBLE_BATCH_SIZE)
+                ).fetchall()
+
+def flush_scrobbles():
+    while True:
+        pending = get_pending_scrobbles()
+        if not pending:
+            return True
+        network = get_network(interactive=False)
+        if network is None:
+            return False
+        ids = [(scrobble_id,) for scrobble_id, *_ in pending]
+        batch = [
+                {'artist': artist, 'title': track, 'album': album, 'timestamp': timestamp}
+                for _, artist, track, album, timestamp in pending
+                ]
+        try:
+            network.scrobble_many(batch)
+        except pylast_error('WSError') as e:
+            echo_later(f"Ошибка: {e}")
+            if is_auth_error(e):
+                invalidate_session()
+            elif not is_retryable_error(e):
+                # Only a rejection of the batch itself counts as an attempt;
+                # outages are waited out however long they last.
+                with db_lock, get_db() as db:
+                    db.executemany("UPDATE scrobbles SET attempts = attempts + 1 WHERE id = ?", ids)
+            return False
+        except pylast_error('NetworkError') as e:
+            echo_later("Network error:", str(e))
+            return False
+        except pylast_error('PyLastError') as e:
+            echo_later(f"Ошибка: {e}")
+            return False
+        submitted_at = int(time.time())
+        with db_lock, get_db() as db:
+            db.executemany("UPDATE scrobbles SET submitted_at = ? WHERE id = ?", [(submitted_at, scrobble_id) for scrobble_id, in ids])
+
+scrobble_flusher = None
+scrobble_wakeup = threading.Event()
+
+def scrobble_flusher_loop():
+    while True:
+        scrobble_wakeup.wait(SCROBBLE_FLUSH_INTERVAL)
+        scrobble_wakeup.clear()
+        # The flusher is started once per run, so it must outlive any error;
+        # the journal keeps the scrobbles for the next pass.
+        try:
+            flush_scrobbles()
+        except Exception as e:
+            echo_later("Scrobbles are not submitted:", e)
+
+def start_scrobble_flusher():
+    global scrobble_flusher
+    with db_lock:
+        if scrobble_flusher is None:
+            scrobble_flusher = threading.Thread(target=scrobble_flusher_loop, daemon=True)
+            scrobble_flusher.start()
+
 def update_now_playing(artist, track, album):
-    network = get_network()
+    network = get_network(interactive=False)
+    if network is None:
+        return None
     try:
         network.update_now_playing(artist=artist, title=track, album=album) 
-    except pylast.WSError as e:
-        print(f"Ошибка: {e}")
+    except pylast_error('WSError') as e:
+        echo_later(f"Ошибка: {e}")
+        if is_auth_error(e):
+            invalidate_session()
+        return None
+    except pylast_error('PyLastError') as e:
+        echo_later(f"Ошибка: {e}")
         return None
     return "Success"
 
+now_playing_timer = None
+now_playing_lock = threading.Lock()
+
+def start_now_playing_timer(delay, artist, track, album):
+    timer = threading.Timer(delay, refresh_now_playing, args=(artist, track, album))
+    timer.daemon = True
+    timer.start()
+    return timer
+
+def start_now_playing(artist, track, album):
+    global now_playing_timer
+    with now_playing_lock:
+        if now_playing_timer:
+            now_playing_timer.cancel()
+        now_playing_timer = start_now_playing_timer(0, artist, track, album)
+
+def refresh_now_playing(artist, track, album):
+    global now_playing_timer
+    update_now_playing(artist, track, album)
+    with now_playing_lock:
+        if now_playing_timer is threading.current_thread():
+            delay = max(NOW_PLAYING_TTL - NOW_PLAYING_MARGIN, 1)
+            now_playing_timer = start_now_playing_timer(delay, artist, track, album)
+
+def stop_now_playing():
+    global now_playing_timer
+    with now_playing_lock:
+        if now_playing_timer:
+            now_playing_timer.cancel()
+        now_playing_timer = None
+
 # def add_to_loved_tracks(artist, track):
 #     network = get_network()
 #     try:
@@ -207,115 +937,292 @@ def update_now_playing(artist, track, album):
 #         return None
 #     return "Success"
 
-def users_track_info(artist, track):
-    network = get_network()
-    track = pylast.Track(artist=artist, title=track, network=network, username=username)
-
-    loved = track.get_userloved()
-    assert loved is not None
-    assert isinstance(loved, bool)
-    assert not isinstance(loved, str)
+track_metadata = OrderedDict()
+track_metadata_lock = threading.Lock()
+
+def get_track_metadata(artist, track):
+    # One track.getInfo call with the username carries the album as well as
+    # the user's play count and loved flag. Kept in memory only, since the
+    # counts change with every scrobble.
+    key = track_key(artist, track)
+    with track_metadata_lock:
+        if key in track_metadata:
+            track_metadata.move_to_end(key)
+            return track_metadata[key]
+    params = {"artist": artist, "track": track}
+    if username:
+        params["username"] = username
+    response = lastfm_get("track.getInfo", params, ttl=0)
+    if 'track' not in response:
+        return None
+    info = response['track']
+    metadata = {
+            'album': info['album']['title'] if info.get('album') else None,
+            'playcount': int(info['userplaycount']) if 'userplaycount' in info else None,
+            'loved': info.get('userloved') == "1"
+            }
+    with track_metadata_lock:
+        track_metadata[key] = metadata
+        while len(track_metadata) > TRACK_METADATA_SIZE:
+            track_metadata.popitem(last=False)
+    return metadata
 
-    count = track.get_userplaycount()
+def forget_track_metadata(artist, track):
+    with track_metadata_lock:
+        track_metadata.pop(track_key(artist, track), None)
 
+def print_users_track_info(count, loved):
     print(f"You listen this track {count} times.")
     if loved:
         print("You LOVE this track.")
-        return
-    return
 
-def get_track_album(artist, track):
-    url = "http://ws.audioscrobbler.com/2.0/?method=track.getInfo"
-    params = {
-            "api_key": api_key,
-            "artist": artist,
-            "track": track,
-            "format": "json"
-            }
-    response = requests.get(url, params=params).json()
-    if response['track'].get('album'):
-        album = response['track']['album']['title']
-    else:
-        album = None
-    return album
+def normalize_name(name):
+    return ' '.join(name.lower().replace("ё", "е").split())
+
+PUNCTUATION_RE = re.compile(r"[^\w\s]|_")
+CYRILLIC_RE = re.compile(r"[\u0400-\u04ff]")
+
+@functools.lru_cache(maxsize=65536)
+def match_key(name):
+    # The spelling names are compared in: NFKC, case-folded, ё as е,
+    # Cyrillic transliterated to Latin (so "Кино" and "Kino" meet), without
+    # punctuation and without a leading or trailing "the".
+    key = unicodedata.normalize("NFKC", name).casefold().replace("ё", "е")
+    if CYRILLIC_RE.search(key):
+        from transliterate import translit
+        key = translit(key, 'ru', reversed=True)
+    words = PUNCTUATION_RE.sub(" ", key).split()
+    if len(words) > 1 and words[0] == "the":
+        words = words[1:]
+    elif len(words) > 1 and words[-1] == "the":
+        words = words[:-1]
+    return ' '.join(words)
+
+def get_trigrams(key):
+    padded = f"  {key} "
+    return frozenset(padded[i:i + 3] for i in range(len(padded) - 2))
+
+class NameIndex:
+    # Trigram index over the names of a site's artists or of an artist's
+    # songs. Names are compared with their words sorted, so a reversed
+    # "Цой Виктор" matches "Виктор Цой", and scored by the Dice coefficient
+    # of their trigrams. With partial=True a name that contains every word
+    # of the query ("Кукушка (live)" for "Кукушка") scores at least 0.8.
+    def __init__(self, entries=(), partial=False):
+        self.partial = partial
+        self.entries = []
+        self.numbers = {}
+        self.postings = {}
+        for name, value in entries:
+            self.add(name, value)
+
+    def add(self, name, value):
+        number = self.numbers.get(name)
+        if number is not None:
+            self.entries[number] = (name, value, *self.entries[number][2:])
+            return
+        words = match_key(name).split()
+        trigrams = get_trigrams(' '.join(sorted(words)))
+        number = len(self.entries)
+        self.entries.append((name, value, frozenset(words), trigrams))
+        self.numbers[name] = number
+        for trigram in trigrams:
+            self.postings.setdefault(trigram, []).append(number)
+
+    def best_match(self, name, threshold=MATCH_THRESHOLD):
+        # Returns (name, value, score) of the best entry, or None.
+        words = frozenset(match_key(name).split())
+        trigrams = get_trigrams(' '.join(sorted(words)))
+        shared = Counter()
+        for trigram in trigrams:
+            shared.update(self.postings.get(trigram, ()))
+        best = None
+        for number, count in shared.items():
+            entry_name, value, entry_words, entry_trigrams = self.entries[number]
+            score = 2 * count / (len(trigrams) + len(entry_trigrams))
+            if self.partial and words and words <= entry_words:
+                score = 0.8 + 0.2 * score
+            if best is None or score > best[2]:
+                best = (entry_name, value, score)
+        if best is None or best[2] < threshold:
+            return None
+        return best
+
+def get_cached_chords(artist, track, site):
+    now = time.time()
+    with db_lock:
+        db = get_db()
+        row = db.execute(
+                "SELECT text, artist_url, track_url, fetched_at FROM chords_cache WHERE artist = ? AND track = ? AND site = ?",
+                (artist, track, site)
+                ).fetchone()
+        if not row:
+            return None
+        text, artist_url, track_url, fetched_at = row
+        ttl = CHORDS_CACHE_TTL if text else CHORDS_MISS_TTL
+        if now - fetched_at > ttl:
+            return None
+        with db:
+            db.execute(
+                    "UPDATE chords_cache SET accessed_at = ? WHERE artist = ? AND track = ? AND site = ?",
+                    (now, artist, track, site)
+                    )
+    return text, artist_url, track_url
+
+def store_cached_chords(artist, track, site, text, artist_url, track_url):
+    now = time.time()
+    with db_lock, get_db() as db:
+        db.execute(
+                "INSERT OR REPLACE INTO chords_cache VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                (artist, track, site, text, artist_url, track_url, now, now)
+                )
+        db.execute(
+                "DELETE FROM chords_cache WHERE (artist, track, site) IN"
+                " (SELECT artist, track, site FROM chords_cache ORDER BY accessed_at DESC LIMIT -1 OFFSET ?)",
+                (CHORDS_CACHE_SIZE,)
+                )
+
+class LookupCancelled(Exception):
+    pass
+
+def check_cancelled(cancel):
+    if cancel is not None and cancel.is_set():
+        raise LookupCancelled()
+
+class LinkedEvent(threading.Event):
+    # Counts as set once its parent is, so one lookup can be cancelled on
+    # its own or together with the whole prefetch it belongs to.
+    def __init__(self, parent=None):
+        super().__init__()
+        self.parent = parent
+
+    def is_set(self):
+        return super().is_set() or self.parent is not None and self.parent.is_set()
+
+def resolve_text_and_chords(artist, track, refresh=False, sites=CHORD_SITES, cancel=None, deadline=CHORDS_SOURCE_DEADLINE):
+    # Playback gives up on slow sites after `deadline` seconds; batch work
+    # passes deadline=None and waits for every site that is still working.
+    cancel = LinkedEvent(cancel)
+    executor = ThreadPoolExecutor(max_workers=len(sites))
+    futures = [submit_with_console(executor, get_text_and_chords, artist, track, site, refresh, cancel) for site in sites]
+    if deadline is not None:
+        deadline += time.monotonic()
+    try:
+        for site, future in zip(sites, futures):
+            try:
+                timeout = None if deadline is None else max(deadline - time.monotonic(), 0)
+                text_and_chords = future.result(timeout=timeout)
+            except FutureTimeoutError:
+                echo(f"{site} is too slow, skipping.")
+                continue
+            if text_and_chords:
+                return text_and_chords
+        return None
+    finally:
+        cancel.set()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+def get_text_and_chords(artist, track, site, refresh=False, cancel=None):
+    artist = normalize_name(artist)
+    track = normalize_name(track)
+    echo(f"Find by {site}")
+    with trace_span('chords', site) as span:
+        if not refresh:
+            cached = get_cached_chords(artist, track, site)
+            if cached and cached[0]:
+                echo("Found in cache.")
+                span['cache'] = 'hit'
+                return cached[0]
+            if cached:
+                # A recent miss, kept for CHORDS_MISS_TTL.
+                echo("Not found, cached.")
+                span['cache'] = 'negative'
+                return None
+        span['cache'] = 'miss'
+        try:
+            text, artist_url, track_url = scrape_text_and_chords(artist, track, site, cancel)
+        except request_errors() as e:
+            echo("Network error:", str(e))
+            return None
+        except LookupCancelled:
+            span['cancelled'] = True
+            return None
+        span['found'] = bool(text)
+        store_cached_chords(artist, track, site, text, artist_url, track_url)
+        return text
 
-def get_text_and_chords(artist, track, site):
+def scrape_text_and_chords(artist, track, site, cancel=None):
     track_href = ""
-    artist = artist.lower().replace("ё", "е")
-    track = track.lower().replace("ё", "е")
-    print(f"Find by {site}")
-    artist_link = get_artist_link(artist, site)
+    artist_link = get_artist_link(artist, site, cancel)
+    artist_words = artist.split()
+    if not artist_link and len(artist_words) > 1:
+        # The name index ignores word order, but the letter page to read is
+        # picked by the first word: "Цой Виктор" is listed under "В".
+        artist_link = get_artist_link(' '.join(reversed(artist_words)), site, cancel)
     if not artist_link:
-        artist_words = artist.split()
-        if len(artist_words) > 1:
-            artist_reversed = ' '.join(reversed(artist_words))
-            artist_link = get_artist_link(artist_reversed, site)
-            if not artist_link:
-                return None
-        else:
-            return None
+        return None, None, None
 
-    artist_url = f"https://www.muzbar.ru{artist_link}"
+    artist_url = f"{SITE_ROOTS['muzbar']}{artist_link}"
     if site == "oduvanchik":
-        artist_url = f"https://www.oduvanchik.net/{artist_link}"
+        artist_url = f"{SITE_ROOTS['oduvanchik']}/{artist_link}"
     elif site == "mytabs":
-        artist_url = f"https://mytabs.ru{artist_link}"
+        artist_url = f"{SITE_ROOTS['mytabs']}{artist_link}"
 
-    print("Artist's url is found: ",artist_url)
-    response = requests.get(artist_url)
+    echo("Artist's url is found: ",artist_url)
+    check_cancelled(cancel)
+    response = http_get(artist_url)
+    response.raise_for_status()
     if response.status_code == 200:
-        soup = BeautifulSoup(response.content, 'html.parser')
+        soup = make_soup(response.content, ARTIST_PAGE_STRAINER, 'artist page')
         if site == "oduvanchik":
             table = soup.find('div', class_='text')
-            links = table.find_all('a', href=lambda href: href and 'view_song' in href)
+            link_filter = {'href': lambda href: href and 'view_song' in href}
         elif site == "mytabs":
             table = soup.find('div', class_='table-responsive')
-            links = table.find_all('a', class_='songtitle')
+            link_filter = {'class_': 'songtitle'}
         else:
             table = soup.find('table', class_='tabs_table')
-            links = table.find_all('a')
-        for link in links:
-            link_text = link.get_text(strip=True)
-            link_text = link_text.lower().replace("ё", "е")
-            if track in link_text:
-                track_link = link
-                if track_link:
-                    track_href = track_link.get('href')
+            link_filter = {}
+        if table is None:
+            echo("The artist page has no list of songs.")
+            return None, artist_url, None
+        links = table.find_all('a', **link_filter)
+        songs = NameIndex(((link.get_text(strip=True), link.get('href')) for link in links), partial=True)
+        match = songs.best_match(track)
+        if match:
+            if match[2] < 1:
+                echo(f"Closest song: {match[0]} ({match[2]:.2f})")
+            track_href = match[1]
     if track_href:
-        track_url = f"https://www.muzbar.ru{track_href}"
+        track_url = f"{SITE_ROOTS['muzbar']}{track_href}"
         if site == "oduvanchik":
-            track_url = f"https://www.oduvanchik.net/{track_href}"
+            track_url = f"{SITE_ROOTS['oduvanchik']}/{track_href}"
         elif site == "mytabs":
-            track_url = f"https://mytabs.ru{track_href}"
-        print("Track's url is found: ",track_url)
-        response = requests.get(track_url)
+            track_url = f"{SITE_ROOTS['mytabs']}{track_href}"
+        echo("Track's url is found: ",track_url)
+        check_cancelled(cancel)
+        response = http_get(track_url)
+        response.raise_for_status()
         if response.status_code == 200:
-            soup = BeautifulSoup(response.content, 'html.parser')
-            text_and_chords_div = soup.find('div', class_='chords')
-            if text_and_chords_div:
-                pre_tags = text_and_chords_div.find_all('pre')
-            if site == "oduvanchik" or "mytabs":
-                pre_tags = soup.find_all('pre')
-                for pre_tag in pre_tags:
-                    text = pre_tag.get_text().replace('\n', '\n')
-                    return text
-            text_and_chords = '\n\n'.join(pre_tag.get_text(strip=True) for pre_tag in pre_tags)
-            return text_and_chords
-    else:
-        return None
+            soup = make_soup(response.content, TRACK_PAGE_STRAINER, 'track page')
+            # All three sites put the song in the first <pre> of the page.
+            pre_tag = soup.find('pre')
+            text_and_chords = pre_tag.get_text() if pre_tag else ''
+            return text_and_chords, artist_url, track_url
+        return None, artist_url, track_url
+    return None, artist_url, None
 
 def is_cyrillic(char):
     return unicodedata.name(char).find('CYRILLIC') >= 0
 
 def transliterate_letter(letter):
     if letter.isalpha():
+        from transliterate import translit
         return translit(letter, 'ru', reversed=True).lower()
     else:
         return letter
 
-def get_artist_link(artist, site):
-    first_word = artist.split()[0]
-    letter = first_word[0]
+def get_letter_url(letter, site):
     if site == "oduvanchik":
         letter = letter.upper()
         letter_bytes = letter.encode('cp1251')
@@ -328,241 +1235,755 @@ def get_artist_link(artist, site):
                 letter = f"{letter}-r"
     if letter.isdigit():
         letter = "other"
-        if site == "oduvanchik" or "mytabs":
+        if site in ("oduvanchik", "mytabs"):
             letter = "0-9"
 
-    letter_url = f"https://www.muzbar.ru/tabs/?letter={letter}"
+    letter_url = f"{SITE_ROOTS['muzbar']}/tabs/?letter={letter}"
     if site == "oduvanchik":
-        letter_url = f"https://www.oduvanchik.net/art_ltr.php?id=%{letter}"
+        letter_url = f"{SITE_ROOTS['oduvanchik']}/art_ltr.php?id=%{letter}"
     elif site == "mytabs":
-        letter_url = f"https://mytabs.ru/akkordy/{letter}"
-    if letter_url:
-        print(f"{letter}-letter's url is found: ", letter_url)
+        letter_url = f"{SITE_ROOTS['mytabs']}/akkordy/{letter}"
+    return letter, letter_url
+
+# (tags, classes) for SoupStrainer, built on first use by get_strainer().
+LETTER_PAGE_STRAINER = (('div',), ('media-body', 'text', 'table-responsive', 'wp-pagenavi'))
+ARTIST_PAGE_STRAINER = (('div', 'table'), ('text', 'table-responsive', 'tabs_table'))
+TRACK_PAGE_STRAINER = (('pre',), None)
+LASTFM_SIMILAR_STRAINER = (('h2', 'h3', 'ol'), None)
+
+@functools.lru_cache(maxsize=None)
+def get_strainer(strainer):
+    from bs4 import SoupStrainer
+    tags, classes = strainer
+    if classes:
+        return SoupStrainer(list(tags), class_=list(classes))
+    return SoupStrainer(list(tags))
+
+def make_soup(content, parse_only=None, name='page'):
+    # Only the containers the scrapers read are materialized; the rest of
+    # the page is skipped by the parser.
+    from bs4 import BeautifulSoup
+    with trace_span('parse', name, bytes=len(content)):
+        return BeautifulSoup(content, HTML_PARSER, parse_only=get_strainer(parse_only) if parse_only else None)
+
+class LetterPageParser(HTMLParser):
+    # Streaming alternative to make_soup() + extract_artist_links() for the
+    # long mytabs letter pages: it keeps only artist links and page numbers.
+    CONTAINERS = ('media-body', 'table-responsive', 'wp-pagenavi')
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.containers = []
+        self.media_links = []
+        self.table_links = []
+        self.page_labels = []
+        self.link = None
+        self.link_text = []
+        self.media_body_used = False
+
+    def get_container(self):
+        for container in reversed(self.containers):
+            if container:
+                return container
+        return None
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'div':
+            classes = (dict(attrs).get('class') or '').split()
+            container = next((name for name in self.CONTAINERS if name in classes), None)
+            if container == 'media-body':
+                self.media_body_used = False
+            self.containers.append(container)
+        elif tag == 'a' and self.link is None:
+            container = self.get_container()
+            if container == 'media-body' and self.media_body_used:
+                return
+            if container:
+                self.link = (container, dict(attrs).get('href'))
+                self.link_text = []
+
+    def handle_endtag(self, tag):
+        if tag == 'div' and self.containers:
+            self.containers.pop()
+        elif tag == 'a' and self.link is not None:
+            container, href = self.link
+            text = ''.join(piece.strip() for piece in self.link_text)
+            if container == 'wp-pagenavi':
+                self.page_labels.append(text.strip())
+            elif href:
+                links = self.media_links if container == 'media-body' else self.table_links
+                links.append((normalize_name(text), href))
+            if container == 'media-body':
+                self.media_body_used = True
+            self.link = None
+
+    def handle_data(self, data):
+        if self.link is not None:
+            self.link_text.append(data)
+
+    def get_links(self):
+        return self.media_links + self.table_links
+
+    def get_max_page(self):
+        if len(self.page_labels) > 1 and self.page_labels[-2].isdigit():
+            return int(self.page_labels[-2])
+        return 1
+
+def parse_letter_page_stream(response):
+    content_type = response.headers.get('content-type', '').lower()
+    encoding = response.encoding if 'charset' in content_type else 'utf-8'
+    decoder = codecs.getincrementaldecoder(encoding)(errors='replace')
+    parser = LetterPageParser()
+    with trace_span('parse', 'letter page (streamed)', bytes=0) as span:
+        for chunk in response.iter_content(chunk_size=64 * 1024):
+            span['bytes'] += len(chunk)
+            parser.feed(decoder.decode(chunk))
+        parser.feed(decoder.decode(b'', final=True))
+        parser.close()
+    return parser
+
+def fetch_mytabs_page(url):
+    with http_get(url, stream=True) as response:
+        response.raise_for_status()
+        return parse_letter_page_stream(response)
+
+def fetch_letter_page(url, site):
+    if site == "mytabs":
+        parser = fetch_mytabs_page(url)
+        return parser.get_links(), parser.get_max_page()
+    response = http_get(url)
+    response.raise_for_status()
+    soup = make_soup(response.content, LETTER_PAGE_STRAINER, 'letter page')
+    return list(extract_artist_links(soup, site)), get_max_page(soup)
+
+def get_max_page(soup):
+    pagenavi = soup.find('div', class_='wp-pagenavi')
+    if pagenavi:
+        page_links = pagenavi.find_all('a')
+        if len(page_links) > 1 and page_links[-2].get_text().isdigit():
+            return int(page_links[-2].get_text())
+    return 1
+
+def fetch_letter_pages(letter, letter_url, site, cancel=None):
+    check_cancelled(cancel)
+    links, max_page = fetch_letter_page(letter_url, site)
+    yield links
+    if site != "mytabs":
+        return
+    for current_page in range(2, max_page + 1):
+        echo(f"Find artist: page {current_page} of {max_page}")
+        check_cancelled(cancel)
+        links, _ = fetch_letter_page(get_mytabs_page_url(letter, letter_url, current_page), site)
+        yield links
+
+def get_mytabs_page_url(letter, letter_url, page):
+    if page == 1:
+        return letter_url
+    return f"{SITE_ROOTS['mytabs']}/akkordy/{letter}?page={page}"
+
+class UnsortedLetterPages(Exception):
+    pass
+
+def get_page_bounds(letter):
+    since = time.time() - INDEX_MAX_AGE
+    with db_lock:
+        rows = get_db().execute(
+                "SELECT page, first_name, last_name, pages FROM letter_pages"
+                " WHERE site = 'mytabs' AND letter = ? AND fetched_at >= ?",
+                (letter, since)
+                ).fetchall()
+    return {page: (first_name, last_name, pages) for page, first_name, last_name, pages in rows}
+
+def store_letter_page(letter, page, parser):
+    names = [name for name, _ in parser.table_links]
+    store_artist_links('mytabs', letter, parser.get_links())
+    with db_lock, get_db() as db:
+        if names:
+            db.execute(
+                    "INSERT OR REPLACE INTO letter_pages VALUES ('mytabs', ?, ?, ?, ?, ?, ?)",
+                    (letter, page, names[0], names[-1], parser.get_max_page(), time.time())
+                    )
+
+def search_mytabs_letter(artist, letter, letter_url, cancel=None, span=None):
+    # The letter pages list artists alphabetically, so a binary search by
+    # each page's first and last name needs O(log pages) fetches. Bounds of
+    # pages seen before (and every link on them) are kept in the database,
+    # so later lookups start from a narrower range or need no fetch at all.
+    # Only an exact name ends the search early; the closest fuzzy match on
+    # the fetched pages is returned once the bisection is over.
+    # Raises UnsortedLetterPages if the site's order doesn't match ours.
+    bounds = get_page_bounds(letter)
+    fetched = set()
+    closest = []
+    def fetch(page):
+        check_cancelled(cancel)
+        if page > 1:
+            echo(f"Find artist: page {page}")
+        parser = fetch_mytabs_page(get_mytabs_page_url(letter, letter_url, page))
+        fetched.add(page)
+        if span is not None:
+            span['pages'] = span.get('pages', 0) + 1
+        names = [name for name, _ in parser.table_links]
+        if names != sorted(names) or any(
+                (other < page and last_name > names[0]) or (other > page and first_name < names[-1])
+                for other, (first_name, last_name, _) in bounds.items() if names and other != page
+                ):
+            raise UnsortedLetterPages()
+        store_letter_page(letter, page, parser)
+        if names:
+            bounds[page] = (names[0], names[-1], parser.get_max_page())
+        return parser
+    def is_found(parser):
+        match = NameIndex(parser.get_links()).best_match(artist)
+        if match:
+            closest.append(match)
+        return match is not None and match[2] == 1
+    def best_link():
+        if not closest:
+            return None
+        name, href, score = max(closest, key=lambda match: match[2])
+        if score < 1:
+            echo(f"Closest artist: {name} ({score:.2f})")
+        return href
+
+    if 1 in bounds:
+        max_page = bounds[1][2]
     else:
-        print(f"{letter}-letter's is not found.")
+        parser = fetch(1)
+        if is_found(parser):
+            return best_link()
+        max_page = parser.get_max_page()
+    low, high = 1, max_page
+    for page, (first_name, last_name, _) in bounds.items():
+        if artist < first_name:
+            high = min(high, page - 1)
+        elif artist > last_name:
+            low = max(low, page + 1)
+        else:
+            # Every link of a stored page is in artist_index, which
+            # get_artist_link has searched already.
+            return best_link()
+    while low <= high:
+        page = (low + high) // 2
+        if page not in fetched and is_found(fetch(page)):
+            return best_link()
+        if page not in bounds:
+            break
+        first_name, last_name, _ = bounds[page]
+        if artist < first_name:
+            high = page - 1
+        elif artist > last_name:
+            low = page + 1
+        else:
+            break
+    return best_link()
+
+def extract_artist_links(soup, site):
+    media_bodies = soup.find_all('div', class_='media-body')
+    for media_body in media_bodies:
+        link = media_body.find('a')
+        if link and link.get('href'):
+            yield normalize_name(link.get_text(strip=True)), link.get('href')
+    if site == "oduvanchik":
+        artists_table_div = soup.find('div', class_='text')
+        if artists_table_div:
+            artists_table = artists_table_div.find('table')
+            if artists_table:
+                for link in artists_table.find_all('a'):
+                    if link.get('href'):
+                        yield normalize_name(link.get_text(strip=True)), link.get('href')
+    elif site == "mytabs":
+        artists_table_div = soup.find('div', class_='table-responsive')
+        if artists_table_div:
+            for link in artists_table_div.find_all('a'):
+                if link.get('href'):
+                    yield normalize_name(link.get_text(strip=True)), link.get('href')
+
+artist_index_versions = {}
+artist_name_indexes = {}
+
+def store_artist_links(site, letter, links, replace_letter=False):
+    links = list(links)
+    with db_lock, get_db() as db:
+        if replace_letter:
+            db.execute("DELETE FROM artist_index WHERE site = ? AND letter = ?", (site, letter))
+        db.executemany(
+                "INSERT OR REPLACE INTO artist_index VALUES (?, ?, ?, ?)",
+                [(site, name, letter, href) for name, href in links]
+                )
+        artist_index_versions[site] = artist_index_versions.get(site, 0) + 1
+        name_index = artist_name_indexes.get(site)
+        if replace_letter:
+            # Artists gone from the letter must leave the name index too.
+            artist_name_indexes.pop(site, None)
+        elif name_index is not None:
+            for name, href in links:
+                name_index.add(name, href)
+
+def get_artist_name_index(site):
+    # Built from artist_index once per site and then kept up to date by
+    # store_artist_links; the build itself runs outside the lock.
+    while True:
+        with db_lock:
+            name_index = artist_name_indexes.get(site)
+            if name_index is not None:
+                return name_index
+            version = artist_index_versions.get(site, 0)
+            rows = get_db().execute("SELECT name, href FROM artist_index WHERE site = ?", (site,)).fetchall()
+        name_index = NameIndex(rows)
+        with db_lock:
+            if artist_index_versions.get(site, 0) == version:
+                artist_name_indexes[site] = name_index
+                return name_index
+
+def find_artist_link(artist, links):
+    match = NameIndex(links).best_match(artist)
+    if match:
+        if match[2] < 1:
+            echo(f"Closest artist: {match[0]} ({match[2]:.2f})")
+        return match[1]
+    return None
 
-    response = requests.get(letter_url)
-    if response.status_code == 200:
-        soup = BeautifulSoup(response.content, 'html.parser')
-        media_bodies = soup.find_all('div', class_='media-body')
-        for media_body in media_bodies:
-            link = media_body.find('a')
-            if link:
-                link_text = link.get_text(strip=True)
-                link_text = link_text.lower().replace("ё", "е")
-                if link_text == artist:
-                    artist_link = link
-                    if artist_link:
-                        artist_href = artist_link.get('href')
-                        return artist_href
-        if site == "oduvanchik":
-            artists_table_div = soup.find('div', class_='text')
-            if artists_table_div:
-                artists_table = artists_table_div.find('table')
-                if artists_table:
-                    links = artists_table.find_all('a')
-                    for link in links:
-                        link_text = link.get_text(strip=True)
-                        link_text = link_text.lower().replace("ё", "е")
-                        if link_text == artist:
-                            artist_link = link
-                            if artist_link:
-                                artist_href = artist_link.get('href')
-                                return artist_href
+def get_artist_link(artist, site, cancel=None):
+    letter, letter_url = get_letter_url(artist.split()[0][0], site)
+    with trace_span('artist link', site, source='index') as span:
+        with db_lock:
+            db = get_db()
+            row = db.execute("SELECT href FROM artist_index WHERE site = ? AND name = ?", (site, artist)).fetchone()
+            if row:
+                return row[0]
+            indexed = db.execute(
+                    "SELECT built_at FROM artist_index_letters WHERE site = ? AND letter = ?", (site, letter)
+                    ).fetchone()
+        # A reordered or differently spelled name is still matched whole;
+        # a merely close one only once its letter has nothing better.
+        match = get_artist_name_index(site).best_match(artist)
+        fresh = indexed and time.time() - indexed[0] <= INDEX_MAX_AGE
+        if match and (match[2] == 1 or fresh):
+            echo(f"Closest indexed artist: {match[0]} ({match[2]:.2f})")
+            return match[1]
+        if fresh:
+            return None
 
-        elif site == "mytabs":
-            current_page = 1
-            while True:
-                if current_page > 1:
-                    letter_url = f"https://mytabs.ru/akkordy/{letter}?page={current_page}"
-                    response = requests.get(letter_url)
-                    if response.status_code == 200:
-                        soup = BeautifulSoup(response.content, 'html.parser')
-                artists_table_div = soup.find('div', class_='table-responsive')
-                if artists_table_div:
-                    links = artists_table_div.find_all('a')
-                    for link in links:
-                        link_text = link.get_text(strip=True)
-                        link_text = link_text.lower().replace("ё", "е")
-                        if link_text == artist:
-                            artist_link = link
-                            if artist_link:
-                                artist_href = artist_link.get('href')
-                                # print("Artist's href is", artist_href)
-                                return artist_href
-                pagenavi = soup.find('div', class_='wp-pagenavi')
-                if pagenavi:
-                    last_page_link = pagenavi.find_all('a')[-2]
-                    max_page = 0
-                    if last_page_link and last_page_link.get_text().isdigit():
-                        max_page = int(last_page_link.get_text())
-                    else:
-                        break
-                    print(f"Find artist: page {current_page} of {max_page}")
-                    if current_page >= max_page:
-                        break
-                current_page += 1
+        echo(f"{letter}-letter's url is found: ", letter_url)
+        span['pages'] = 0
+        if site == "mytabs":
+            span['source'] = 'search'
+            try:
+                return search_mytabs_letter(artist, letter, letter_url, cancel, span) or (match and match[1])
+            except UnsortedLetterPages:
+                echo("Letter pages are not in alphabetical order, reading them all.")
+        span['source'] = 'crawl'
+        crawled = []
+        try:
+            for links in fetch_letter_pages(letter, letter_url, site, cancel):
+                span['pages'] += 1
+                crawled += links
+                if any(name == artist for name, _ in links):
+                    break
+        finally:
+            store_artist_links(site, letter, crawled)
+        return find_artist_link(artist, crawled) or (match and match[1])
+
+def build_letter_index(letter, letter_url, site):
+    artists = {}
+    pages = 0
+    for links in fetch_letter_pages(letter, letter_url, site):
+        pages += 1
+        for name, href in links:
+            artists.setdefault(name, href)
+    store_artist_links(site, letter, artists.items(), replace_letter=True)
+    with db_lock, get_db() as db:
+        db.execute(
+                "INSERT OR REPLACE INTO artist_index_letters VALUES (?, ?, ?, ?)", (site, letter, pages, time.time())
+                )
+    return len(artists)
+
+def build_artist_index(sites):
+    for site in sites:
+        with db_lock:
+            built = dict(get_db().execute(
+                    "SELECT letter, built_at FROM artist_index_letters WHERE site = ?", (site,)
+                    ).fetchall())
+        letters = {}
+        for char in INDEX_ALPHABET:
+            letter, letter_url = get_letter_url(char, site)
+            if time.time() - built.get(letter, 0) > INDEX_MAX_AGE:
+                letters[letter] = letter_url
+        print(f"Building {site} index: {len(letters)} letters to crawl")
+        with ThreadPoolExecutor(max_workers=INDEX_WORKERS) as executor:
+            futures = {
+                    executor.submit(build_letter_index, letter, letter_url, site): letter
+                    for letter, letter_url in letters.items()
+                    }
+            for future in as_completed(futures):
+                try:
+                    print(f"{site} {futures[future]}: {future.result()} artists")
+                except request_errors() as e:
+                    print(f"{site} {futures[future]}: network error:", str(e))
+
+def read_setlist(path):
+    entries = []
+    with open(path, encoding='utf-8') as setlist:
+        for line in setlist:
+            line = line.strip()
+            if not line or line.startswith('#'):
+                continue
+            artist, separator, track = line.replace(" – ", " - ").partition(" - ")
+            if not separator or not artist.strip() or not track.strip():
+                print(f"Skipping line without \"artist - track\": {line}")
+                continue
+            entries.append((artist.strip(), track.strip()))
+    return entries
+
+def get_setlist_file_name(index, artist, track):
+    return re.sub(r'[\\/:*?"<>|]+', '_', f"{index:02d} {artist} - {track}.txt")
+
+def resolve_setlist_entry(artist, track, refresh):
+    console.quiet = True
+    try:
+        return resolve_text_and_chords(artist, track, refresh, deadline=None)
+    finally:
+        console.quiet = False
+
+def resolve_setlist(path, output, refresh=False):
+    # Looks up every song of a setlist in parallel, which also warms the
+    # chords cache, and writes one text file per song plus misses.txt.
+    entries = read_setlist(path)
+    results = {}
+    with ThreadPoolExecutor(max_workers=SETLIST_WORKERS) as executor:
+        futures = {
+                executor.submit(resolve_setlist_entry, artist, track, refresh): index
+                for index, (artist, track) in enumerate(entries, 1)
+                }
+        for done, future in enumerate(as_completed(futures), 1):
+            index = futures[future]
+            artist, track = entries[index - 1]
+            try:
+                results[index] = future.result()
+            except request_errors() as e:
+                results[index] = None
+                print(f"[{done}/{len(entries)}] {artist} - {track}: network error:", str(e))
+                continue
+            except Exception as e:
+                # One odd page must not cost the files of the whole setlist.
+                results[index] = None
+                print(f"[{done}/{len(entries)}] {artist} - {track}: error:", repr(e))
+                continue
+            print(f"[{done}/{len(entries)}] {artist} - {track}: {'found' if results[index] else 'not found'}")
+
+    files = {}
+    misses = []
+    for index, (artist, track) in enumerate(entries, 1):
+        if results.get(index):
+            files[get_setlist_file_name(index, artist, track)] = f"{artist} - {track}\n\n{results[index]}\n"
+        else:
+            misses.append(f"{artist} - {track}")
+    if misses:
+        files["misses.txt"] = '\n'.join(misses) + '\n'
+    if output.endswith('.zip'):
+        import zipfile
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for name, content in files.items():
+                archive.writestr(name, content)
+    else:
+        os.makedirs(output, exist_ok=True)
+        for name, content in files.items():
+            with open(os.path.join(output, name), 'w', encoding='utf-8') as file:
+                file.write(content)
+    return len(entries) - len(misses), len(misses)
+
+def get_artist_name(track):
+    if isinstance(track.get('artist'), dict):
+        return track['artist'].get('name', '')
+    return track.get('artist', '')
+
+def prefetch_next_track(track, transition=None, cancel=None):
+    console.quiet = True
+    tracing.transition = transition
+    tracing.background = True
+    try:
+        next_track = search_similar_track(track)
+        if not next_track:
+            return None
+        check_cancelled(cancel)
+        artist_name = get_artist_name(next_track)
+        text_and_chords = resolve_text_and_chords(artist_name, next_track['name'], args.refresh, cancel=cancel)
+        check_cancelled(cancel)
+        return {
+                'track': next_track,
+                'metadata': get_track_metadata(artist_name, next_track['name']),
+                'text_and_chords': text_and_chords,
+                'chord_sheet': parse_chord_sheet(text_and_chords) if text_and_chords else None
+                }
+    except request_errors() + pylast_error('PyLastError') + (LookupError, ValueError, LookupCancelled):
+        return None
+    finally:
+        console.quiet = False
+        tracing.transition = None
+        tracing.background = False
+
+def take_prefetched(prefetch):
+    if prefetch is None:
+        return None
+    prefetched = prefetch.result()
+    if not prefetched:
+        return None
+    next_track = prefetched['track']
+    if is_played(get_artist_name(next_track), next_track['name']):
+        return None
+    return prefetched
+
+def discard_prefetched(prefetch, cancel):
+    # cancel() only helps while the prefetch is queued; a running one stops
+    # at its next request once the event is set.
+    if prefetch is not None:
+        prefetch.cancel()
+        cancel.set()
+
+prefetch_executor = ThreadPoolExecutor(max_workers=1)
 
 def play_track(track):
-    global track_finished, track_passed, artist_aborted, next_searched, new_track, chords_modified, tonality
+    prefetched = None
     while True:
-        if isinstance(track.get('artist'), dict):
-            artist_name = track['artist'].get('name', '')
-        else:
-            artist_name = track.get('artist', '')
+        print_background_messages()
+        if lastfm_network is None:
+            # Last.fm rejected the session key in the background.
+            get_network()
+        artist_name = get_artist_name(track)
         print("Artist: ", artist_name)
         print("Track: ", track['name'])
-        if not new_track:
-            album = get_track_album(artist_name, track['name'])
+        if prefetched and prefetched['track'] is not track:
+            prefetched = None
+        if prefetched:
+            metadata = prefetched['metadata']
+        elif not player.new_track:
+            metadata = get_track_metadata(artist_name, track['name'])
         else:
+            metadata = None
+        if player.new_track and not prefetched:
             album = track['album']
+        else:
+            album = metadata['album'] if metadata else None
         print("Album: ", album)
 
         scrobbled = False
-        if not new_track:
-            users_track_info(artist_name, track['name'])
+        if metadata and metadata['playcount'] is not None:
+            print_users_track_info(metadata['playcount'], metadata['loved'])
 
-        text_and_chords = get_text_and_chords(artist_name, track['name'], "mytabs")
-        if not text_and_chords:
-            text_and_chords = get_text_and_chords(artist_name, track['name'], "muzbar")
-            if not text_and_chords:
-                text_and_chords = get_text_and_chords(artist_name, track['name'], "oduvanchik")
+        if prefetched:
+            text_and_chords = prefetched['text_and_chords']
+            chord_sheet = prefetched['chord_sheet']
+        else:
+            text_and_chords = resolve_text_and_chords(artist_name, track['name'], args.refresh)
+            chord_sheet = parse_chord_sheet(text_and_chords) if text_and_chords else None
+        prefetched = None
+
+        prefetch = None
+        prefetch_cancel = threading.Event()
+        next_transition = new_transition(f"{artist_name} - {track['name']}")
+        if not player.next_searched:
+            prefetch = prefetch_executor.submit(prefetch_next_track, track, next_transition, prefetch_cancel)
 
-        input_thread = None
         if text_and_chords:
+            import pydoc
             pydoc.pager(text_and_chords)
         else:
             print("Text and chords are not found.")
-        if input_thread:
-            input_thread.join()
-        input_thread = threading.Thread(target=input_listener)
+        input_thread = threading.Thread(target=input_listener, args=(player.commands,), daemon=True)
         input_thread.start()
 
-        modified_chords_displayed = False
-        while not track_finished:
-            if chords_modified and not modified_chords_displayed:
-               text_and_chords = modify_chords(text_and_chords, tonality)
-               print(text_and_chords)
-               modified_chords_displayed = True
-
-            update_now_playing(artist_name, track['name'], album)
-            if track_finished:
-                break
-            time.sleep(1)
-
-        if track_finished:
-            print("Track is finishing...")
-            if artist_aborted:
-                print("Artist is aborting...")
-                key = artist_name
-                if key in played_tracks:
-                    aborted_artists[key] += 1
+        start_now_playing(artist_name, track['name'], album)
+        finish = None
+        while finish is None:
+            finish = handle_command(player.commands.get(), chord_sheet)
+        stop_now_playing()
+        begin_transition(next_transition)
+
+        track_passed = finish in ('p', 'ps')
+        artist_aborted = finish == 'n'
+        if finish in ('qs', 'ps'):
+            player.next_searched = True
+
+        print("Track is finishing...")
+        if artist_aborted or player.next_searched or track_passed:
+            discard_prefetched(prefetch, prefetch_cancel)
+        if artist_aborted:
+            print("Artist is aborting...")
+            add_to_aborted_artists(artist_name)
+            add_to_played_tracks(artist_name, track['name'], scrobbled)
+            previous_track = get_previous_track()
+            similar_track = search_similar_track(previous_track)
+            if isinstance(previous_track, str):
+                previous_track = json.loads(previous_track)
+            artist_name = previous_track['artist']
+            track = get_similar_artist_track(artist_name)
+        elif player.next_searched:
+            print("Searching of next track...")
+            if not track_passed:
+                print("\nScrobbling... ")
+                scrobble_track(artist_name, track['name'], album)
+                scrobbled = True
+                print("OK")
+            add_to_played_tracks(artist_name, track['name'], scrobbled)
+            query = input("Input your search query: ")
+            player.next_searched = False
+            player.new_track = False
+            track = search_track(query)
+        else:
+            if not track_passed:
+                print("\nScrobbling... ")
+                scrobble_track(artist_name, track['name'], album)
+                scrobbled = True
+                print("OK")
+                add_to_played_tracks(artist_name, track['name'], scrobbled)
+                prefetched = take_prefetched(prefetch)
+                if prefetched:
+                    similar_track = prefetched['track']
                 else:
-                    aborted_artists[key] = 1
+                    similar_track = search_similar_track(track)
+            else:
+                print("Track is passing...")
                 add_to_played_tracks(artist_name, track['name'], scrobbled)
                 previous_track = get_previous_track()
                 similar_track = search_similar_track(previous_track)
-                if isinstance(previous_track, str):
-                    previous_track = json.loads(previous_track)
-                artist_name = previous_track['artist']
-                artist_aborted = False
-                track_finished = False
-                track = get_similar_artist_track(artist_name)
-            elif next_searched:
-                print("Searching of next track...")
-                if not track_passed:
-                    print("\nScrobbling... ")
-                    scrobble_track(artist_name, track['name'], album)
-                    scrobbled = True
-                    print("OK")
-                add_to_played_tracks(artist_name, track['name'], scrobbled)
-                query = input("Input your search query: ")
-                next_searched = False
-                track_finished = False
-                track_passed = False
-                new_track = False
-                track = search_track(query)
-            else:
-                if not track_passed:
-                    print("\nScrobbling... ")
-                    scrobble_track(artist_name, track['name'], album)
-                    scrobbled = True
-                    print("OK")
-                    add_to_played_tracks(artist_name, track['name'], scrobbled)
-                    similar_track = search_similar_track(track)
-                else:
-                    print("Track is passing...")
-                    add_to_played_tracks(artist_name, track['name'], scrobbled)
-                    previous_track = get_previous_track()
-                    similar_track = search_similar_track(previous_track)
-                    track_passed = False
-                track_finished = False
-                track = similar_track
-        else:
-            break
-
-def input_listener():
-    global track_finished, track_passed, artist_aborted, next_searched, chords_modified, tonality
-    user_input = input()
-    print("Your input is", user_input)
-    while not track_finished:
+            track = similar_track
 
-        if user_input.lower() == 'q':
-            track_finished = True
-
-        elif user_input.lower() == 'p':
-            track_passed = True
-            track_finished = True
-
-        elif user_input.lower() == 'n':
-           artist_aborted = True
-           track_finished = True
-
-        elif user_input.lower() == 'qs':
-            track_finished = True
-            next_searched = True
+def handle_command(user_input, chord_sheet):
+    command = user_input.strip().lower()
+    if command in FINISHING_COMMANDS:
+        return command
+    if command.startswith('m '):
+        try:
+            player.tonality = int(command.split()[1])
+        except (IndexError, ValueError):
+            print("Invalid input. Please use 'm <number>' format.")
+            return None
+    elif command.startswith('c '):
+        try:
+            player.capo = int(command.split()[1])
+        except (IndexError, ValueError):
+            print("Invalid input. Please use 'c <fret>' format.")
+            return None
+    elif command == 'v':
+        player.chords_only = not player.chords_only
+    else:
+        print("Invalid input. Please try again.")
+        return None
+    if chord_sheet:
+        print(chord_sheet.render(player.tonality, player.capo, player.chords_only))
+    return None
 
-        elif user_input.lower() == 'ps':
-            track_passed = True
-            track_finished = True
-            next_searched = True
-        elif user_input.startswith('m '):
-            try:
-                tonality = int(user_input.split()[1])
-                chords_modified = True
-            except (IndexError, ValueError):
-                print("Invalid input. Please use 'm <number>' format.")
-        else:
-            print("Invalid input. Please try again.")
+def input_listener(commands):
+    while True:
         user_input = input()
+        print("Your input is", user_input)
+        commands.put(user_input)
+        if user_input.strip().lower() in FINISHING_COMMANDS:
+            return
+
+SHARP_NOTES = ("C", "C#", "D", "D#", "E", "F", "F#", "G", "G#", "A", "A#", "B")
+FLAT_NOTES = ("C", "Db", "D", "Eb", "E", "F", "Gb", "G", "Ab", "A", "Bb", "B")
+NOTE_INDEX = {
+        "C": 0, "B#": 0, "C#": 1, "Db": 1, "D": 2, "D#": 3, "Eb": 3, "E": 4, "Fb": 4, "E#": 5, "F": 5,
+        "F#": 6, "Gb": 6, "G": 7, "G#": 8, "Ab": 8, "A": 9, "A#": 10, "Bb": 10, "B": 11, "Cb": 11
+        }
+# In H/B notation, common on Russian chord sites, H is B natural and B is B flat.
+GERMAN_NOTE_INDEX = {**NOTE_INDEX, "B": 10, "H": 11, "H#": 0}
+GERMAN_SHARP_NOTES = SHARP_NOTES[:10] + ("B", "H")
+GERMAN_FLAT_NOTES = FLAT_NOTES[:10] + ("B", "H")
+
+CHORD_RE = re.compile(
+        r"([A-H][#b]?)"
+        r"((?:maj|Maj|min|dim|aug|sus|add|m|M|\+|-|°|ø|\d|[#b](?=\d)|\((?:[#b]?\d+|maj\d*|add\d+|sus\d*)\))*)"
+        r"(?:/([A-H][#b]?))?"
+        )
+CHORD_LINE_FILLER_RE = re.compile(r"[|:.\-/()x*\d]+|[^\s:]+:")
+TOKEN_RE = re.compile(r"\S+")
+
+def build_transpose_tables(note_index, sharp_notes, flat_notes):
+    tables = []
+    for offset in range(12):
+        table = {}
+        for note, index in note_index.items():
+            names = flat_notes if note.endswith("b") or note == "B" and note_index is GERMAN_NOTE_INDEX else sharp_notes
+            table[note] = names[(index + offset) % 12]
+        tables.append(table)
+    return tables
+
+TRANSPOSE_TABLES = {
+        "english": build_transpose_tables(NOTE_INDEX, SHARP_NOTES, FLAT_NOTES),
+        "german": build_transpose_tables(GERMAN_NOTE_INDEX, GERMAN_SHARP_NOTES, GERMAN_FLAT_NOTES)
+        }
 
-def modify_chords(text_and_chords, tonality):
-    chord_mapping = {
-        "A": 0, "B": 1, "H": 2, "C": 3, "C#": 4, "D": 5, "D#": 6, "E": 7, "F": 8, "F#": 9, "G": 10, "G#": 11
-    }
-
-    soup = BeautifulSoup(text_and_chords, 'html.parser')
-    text = soup.get_text(strip=True)
-    chords = soup.find_all('span', class_='chords')
-
-    modified_chords = []
-
-    for chord in chords:
-        chord_name = chord.text
-        root_note = chord_name[0]
-        if root_note not in chord_mapping:
-            continue
-        note_index = chord_mapping[root_note]
-        modified_index = (note_index + tonality) % 12
-
-        for note, index in chord_mapping.items():
-            if index == modified_index:
-                modified_name = note + chord_name[1:]
-                break
-        modified_chord = f"<span class=\"chord\"data-chid=\"{chord['data-chid']}\">{modified_name}</span>"
-        modified_chords.append(modified_chord)
-    modified_text = text + "\n\n" + "\n".join(modified_chords)
-    return modified_text
+def tokenize_chord_line(line):
+    tokens = []
+    for match in TOKEN_RE.finditer(line):
+        chord = CHORD_RE.fullmatch(match.group())
+        if chord:
+            tokens.append((match.start(), chord.group(1), chord.group(2), chord.group(3)))
+        elif not CHORD_LINE_FILLER_RE.fullmatch(match.group()):
+            return None
+        else:
+            tokens.append((match.start(), match.group(), None, None))
+    if not any(suffix is not None for _, _, suffix, _ in tokens):
+        return None
+    return tokens
+
+class SheetLine:
+    # A line of a chord sheet: plain text, or chord tokens as
+    # (column, root, suffix, bass) tuples with text set to None.
+    __slots__ = ('text', 'chords')
+
+    def __init__(self, text, chords=None):
+        self.text = text
+        self.chords = chords
+
+    def render(self, table):
+        if self.chords is None:
+            return self.text
+        line = ""
+        for column, root, suffix, bass in self.chords:
+            if suffix is None:
+                chord = root
+            else:
+                chord = table.get(root, root) + suffix
+                if bass:
+                    chord += "/" + table.get(bass, bass)
+            if line:
+                column = max(column, len(line) + 1)
+            line = line.ljust(column) + chord
+        return line
+
+class ChordSheet:
+    __slots__ = ('lines', 'notation', 'renders')
+
+    def __init__(self, lines, notation):
+        self.lines = lines
+        self.notation = notation
+        self.renders = {}
+
+    def render(self, tonality=0, capo=0, chords_only=False):
+        offset = (tonality - capo) % 12
+        key = (offset, chords_only)
+        if key not in self.renders:
+            table = TRANSPOSE_TABLES[self.notation][offset]
+            lines = [line for line in self.lines if line.chords is not None] if chords_only else self.lines
+            self.renders[key] = "\n".join(line.render(table) for line in lines)
+        return self.renders[key]
+
+@functools.lru_cache(maxsize=CHORD_SHEET_CACHE_SIZE)
+def parse_chord_sheet(text_and_chords):
+    lines = []
+    roots = set()
+    for text in text_and_chords.split("\n"):
+        chords = tokenize_chord_line(text)
+        if chords:
+            lines.append(SheetLine(None, tuple(chords)))
+            roots.update(root for _, root, suffix, _ in chords if suffix is not None)
+        else:
+            lines.append(SheetLine(text))
+    return ChordSheet(lines, "german" if "H" in roots else "english")
 
 # def play_album(album):
 #     track_list = get_album_tracks(album)
@@ -694,8 +2115,78 @@ def modify_chords(text_and_chords, tonality):
 #     response = requests.get(url, params=params).json()
 #     track_list = response['toptracks']['track']
 #     return track_list
+def get_track_node(artist, track):
+    return f"t:{track_key(artist, track)}"
+
+def get_artist_node(artist):
+    return f"a:{artist_key(artist)}"
+
+def add_graph_edges(source, edges):
+    if not edges:
+        return
+    now = time.time()
+    with db_lock, get_db() as db:
+        db.executemany(
+                "INSERT OR REPLACE INTO graph_edges VALUES (?, ?, ?, ?, ?, ?)",
+                [(source, target, artist, track, weight, now) for target, artist, track, weight in edges]
+                )
+
+def record_similar_tracks(artist, track, similar_tracks):
+    edges = []
+    for similar_track in similar_tracks:
+        similar_artist = similar_track['artist']['name']
+        weight = float(similar_track.get('match') or 0.5)
+        edges.append((get_track_node(similar_artist, similar_track['name']), similar_artist, similar_track['name'], weight))
+    add_graph_edges(get_track_node(artist, track), edges)
+
+def record_similar_artists(artist, similar_artists):
+    edges = []
+    for similar_artist in similar_artists:
+        name = similar_artist.get('name') or similar_artist.get('artist')
+        weight = float(similar_artist.get('match') or 0.5)
+        edges.append((get_artist_node(name), name, None, weight))
+    add_graph_edges(get_artist_node(artist), edges)
+
+def record_artist_tracks(artist, top_tracks):
+    edges = []
+    for rank, top_track in enumerate(top_tracks, start=1):
+        track_artist = top_track['artist']['name']
+        edges.append((get_track_node(track_artist, top_track['name']), track_artist, top_track['name'], 1 / rank))
+    add_graph_edges(get_artist_node(artist), edges)
+
+def get_graph_edges(node):
+    since = time.time() - GRAPH_MAX_AGE
+    with db_lock:
+        edges = get_db().execute(
+                "SELECT target, artist, track, weight FROM graph_edges WHERE source = ? AND updated_at >= ?",
+                (node, since)
+                ).fetchall()
+    return [edge for edge in edges if edge[3] > 0 and not is_aborted(edge[1])]
+
+def recommend_from_graph(artist, track):
+    start = get_track_node(artist, track)
+    artist_node = get_artist_node(artist)
+    if not get_graph_edges(start) and not get_graph_edges(artist_node):
+        return None
+    for _ in range(GRAPH_WALKS):
+        node, node_artist = start, artist
+        for _ in range(GRAPH_WALK_LENGTH):
+            edges = get_graph_edges(node)
+            if node.startswith("t:"):
+                total = sum(edge[3] for edge in edges) or 1
+                edges.append((get_artist_node(node_artist), node_artist, None, total * GRAPH_ARTIST_HOP))
+            if not edges:
+                break
+            weights = [
+                    weight * GRAPH_PLAYED_DAMPING if edge_track and is_played(edge_artist, edge_track) else weight
+                    for _, edge_artist, edge_track, weight in edges
+                    ]
+            node, node_artist, node_track, _ = random.choices(edges, weights=weights)[0]
+            if node_track and node != start and not is_played(node_artist, node_track):
+                return {'name': node_track, 'artist': {'name': node_artist}}
+    return None
+
 def search_similar_track(track):
-    url = "http://ws.audioscrobbler.com/2.0/?method=track.getsimilar"
     if isinstance(track, str):
         track = json.loads(track)
     if isinstance(track.get('artist'), dict):
@@ -709,10 +2200,18 @@ def search_similar_track(track):
         "limit": 50,
         "format": "json"
         }
-    print("\nSearching next track... ")
-    response = requests.get(url, params=params).json()
+    echo("\nSearching next track... ")
+    if SIMILARITY_GRAPH:
+        with trace_span('recommend', 'graph') as span:
+            graph_track = recommend_from_graph(artist_name, track['name'])
+            span['found'] = graph_track is not None
+        if graph_track:
+            echo(f"\nNext track is from similarity graph: {graph_track['artist']['name']} - {graph_track['name']}")
+            return graph_track
+    response = lastfm_get("track.getsimilar", params)
     if response.get('similartracks'):
         similar_tracks = response['similartracks']['track']
+        record_similar_tracks(artist_name, track['name'], similar_tracks)
     else:
         similar_artist_track = get_similar_artist_track(artist_name)
         return similar_artist_track 
@@ -723,50 +2222,92 @@ def search_similar_track(track):
         if not similar_track:
             similar_artist_track = get_similar_artist_track(artist_name)
             if similar_artist_track:
-                print(f"\nNext track is similar on artist: {similar_artist_track['artist']['name']} - {similar_artist_track['name']}")
+                echo(f"\nNext track is similar on artist: {similar_artist_track['artist']['name']} - {similar_artist_track['name']}")
             else:
                 random_track = get_random_loved_track()
-                print(f"\nNext track is random loved track: {random_track['artist']['name']} - {random_track['name']}")
+                echo(f"\nNext track is random loved track: {random_track['artist']['name']} - {random_track['name']}")
                 return random_track
             return similar_artist_track
-        print(f"\nNext track is similar on track: {similar_track['artist']} - {similar_track['name']}")
+        echo(f"\nNext track is similar on track: {similar_track['artist']} - {similar_track['name']}")
         return similar_track
 
     for similar_track in similar_tracks:
-        key = f"{similar_track['artist']['name']} - {similar_track['name']}"
-        key_lower = key.lower()
-        print("key: ", key_lower)
-        print("played_tracks: ", played_tracks)
-        if key_lower not in played_tracks:
-            print(f"\nNext track is similar on track: {similar_track['artist']['name']} - {similar_track['name']}")
+        if not is_played(similar_track['artist']['name'], similar_track['name']):
+            echo(f"\nNext track is similar on track: {similar_track['artist']['name']} - {similar_track['name']}")
             return similar_track
 
 def get_random_loved_track():
-    print("Searching random loved track... ")
-    url = "http://ws.audioscrobbler.com/2.0/?method=user.getlovedtracks"
-    user = username
+    echo("Searching random loved track... ")
+    synced = get_library_sync()
+    if not synced or time.time() - synced[0] > LIBRARY_MAX_AGE:
+        try:
+            sync_library()
+        except request_errors() as e:
+            echo("Network error:", str(e))
+    with db_lock:
+        db = get_db()
+        count = db.execute("SELECT COUNT(*) FROM loved_tracks").fetchone()[0]
+        if count == 0:
+            raise ValueError("You have no tracks in your lovedtracks.")
+        artist, track = db.execute(
+                "SELECT artist, track FROM loved_tracks LIMIT 1 OFFSET ?", (random.randrange(count),)
+                ).fetchone()
+    echo("OK")
+    return {'name': track, 'artist': {'name': artist}}
+
+def get_library_sync():
+    with db_lock:
+        return get_db().execute("SELECT synced_at, newest FROM library_sync WHERE user = ?", (username,)).fetchone()
+
+def get_loved_page(page):
     params = {
             "api_key": api_key,
-            "user": user,
+            "user": username,
+            "limit": LIBRARY_PAGE_SIZE,
+            "page": page,
             "format": "json"
             }
-    response = requests.get(url, params=params).json()
-    total_pages = int(response['lovedtracks']['@attr']['totalPages'])
-    if total_pages == 0:
-        raise ValueError("You have no tracks in your lovedtracks.")
-    random_page = random.randint(1, total_pages)
-    params["page"] = random_page
-    response = requests.get(url, params=params).json()
-    track_list = response['lovedtracks']['track']
-    random_track = random.choice(track_list)
-    print("OK")
-    return random_track
+    return lastfm_get("user.getlovedtracks", params)['lovedtracks']
+
+def get_loved_at(loved_track):
+    return int(loved_track.get('date', {}).get('uts', 0))
+
+def sync_library(full=False):
+    synced = get_library_sync()
+    newest = synced[1] if synced and not full else 0
+    first_page = get_loved_page(1)
+    total_pages = int(first_page['@attr']['totalPages'])
+    loved_tracks = list(first_page['track'])
+    if newest:
+        # Pages come newest first: stop at the first one that reaches the last sync.
+        page = 1
+        while page < total_pages and loved_tracks and min(map(get_loved_at, loved_tracks)) > newest:
+            page += 1
+            loved_tracks += get_loved_page(page)['track']
+        loved_tracks = [loved_track for loved_track in loved_tracks if get_loved_at(loved_track) > newest]
+    else:
+        with ThreadPoolExecutor(max_workers=LASTFM_CONCURRENCY) as executor:
+            for loved_page in executor.map(with_console(get_loved_page), range(2, total_pages + 1)):
+                loved_tracks += loved_page['track']
+
+    rows = [
+            (track_key(loved_track['artist']['name'], loved_track['name']),
+             loved_track['artist']['name'], loved_track['name'], get_loved_at(loved_track))
+            for loved_track in loved_tracks
+            ]
+    newest = max([newest] + [row[3] for row in rows])
+    with db_lock, get_db() as db:
+        if not synced or full:
+            db.execute("DELETE FROM loved_tracks")
+        db.executemany("INSERT OR REPLACE INTO loved_tracks VALUES (?, ?, ?, ?)", rows)
+        db.execute("INSERT OR REPLACE INTO library_sync VALUES (?, ?, ?)", (username, time.time(), newest))
+    return len(rows)
 
 def extract_similar_track_from_html(artist, track):
-    track_url = f"https://www.last.fm/music/{artist}/_/{track}"
-    response = requests.get(track_url)
+    track_url = f"{LASTFM_WEB_ROOT}/music/{artist}/_/{track}"
+    response = http_get(track_url)
     if response.status_code == 200:
-        soup = BeautifulSoup(response.content, 'html.parser')
+        soup = make_soup(response.content, LASTFM_SIMILAR_STRAINER, 'last.fm page')
         similar_track_section = soup.find('h3', string='Similar Tracks')
         if similar_track_section:
             similar_track_section = similar_track_section.find_next('ol')
@@ -774,8 +2315,7 @@ def extract_similar_track_from_html(artist, track):
             for item in similar_tracks_items:
                 track_title = item.find('h3').find('a').text.strip()
                 track_artist = item.find('p').find('span').find('a').text.strip()
-                key = f"{track_artist} - {track_title}"
-                if key not in played_tracks:
+                if not is_played(track_artist, track_title):
                     data = {
                             'name': track_title,
                             'artist': track_artist
@@ -793,40 +2333,52 @@ def get_similar_artist_track(artist):
                 "limit": 12,
                 "format": "json"
                 }
-        similar_artist_response = requests.get("http://ws.audioscrobbler.com/2.0/?method=artist.getsimilar", params=artist_params).json()
+        similar_artist_response = lastfm_get("artist.getsimilar", artist_params)
         similar_artists = similar_artist_response['similarartists']['artist']
 
         if not similar_artists:
             similar_artists = extract_similar_artist_from_html(artist)
+        record_similar_artists(artist, similar_artists or [])
 
+        candidates = []
         for artist in similar_artists:
             if 'artist' in artist:
                 artist_name = artist['artist']
             else:
                 artist_name = artist['name']
-            key = f"{artist_name}"
-            if key not in aborted_artists:
-                top_tracks_params = {
-                    "api_key": api_key,
-                    "artist": artist_name,
-                    "limit": 6,
-                    "format": "json"
-                    }
-                top_tracks_response = requests.get("http://ws.audioscrobbler.com/2.0/?method=artist.gettoptracks", params=top_tracks_params).json()
-                top_tracks = top_tracks_response['toptracks']['track']
+            if not is_aborted(artist_name):
+                candidates.append(artist_name)
 
+        # Top tracks of all candidates are fetched concurrently, but map()
+        # yields them in similarity order, so the pick stays deterministic.
+        executor = ThreadPoolExecutor(max_workers=SIMILAR_ARTIST_WORKERS)
+        try:
+            for top_tracks in executor.map(with_console(get_artist_top_tracks), candidates):
                 for top_track in top_tracks:
-                    key = f"{top_track['artist']['name']} - {top_track['name']}"
-                    if key not in played_tracks:
+                    if not is_played(top_track['artist']['name'], top_track['name']):
                         # print("OK")
                         return top_track
+        finally:
+            executor.shutdown(wait=False, cancel_futures=True)
+
+def get_artist_top_tracks(artist_name):
+    top_tracks_params = {
+        "api_key": api_key,
+        "artist": artist_name,
+        "limit": 6,
+        "format": "json"
+        }
+    top_tracks_response = lastfm_get("artist.gettoptracks", top_tracks_params)
+    top_tracks = top_tracks_response.get('toptracks', {}).get('track', [])
+    record_artist_tracks(artist_name, top_tracks)
+    return top_tracks
 
 def extract_similar_artist_from_html(artist):
     similar_artists = []
-    artist_url = f"https://www.last.fm/music/{artist}/+similar"
-    response = requests.get(artist_url)
+    artist_url = f"{LASTFM_WEB_ROOT}/music/{artist}/+similar"
+    response = http_get(artist_url)
     if response.status_code == 200:
-        soup = BeautifulSoup(response.content, 'html.parser')
+        soup = make_soup(response.content, LASTFM_SIMILAR_STRAINER, 'last.fm page')
         similar_artists_section = soup.find('h2', string='Similar Artists')
         if similar_artists_section:
             similar_artists_section = similar_artists_section.find_next('ol')
@@ -841,36 +2393,41 @@ def extract_similar_artist_from_html(artist):
             return similar_artists
     
 def get_request_token(api_key, api_secret):
-    url = "http://ws.audioscrobbler.com/2.0/?method=auth.getToken"
-    api_sig = hashlib.md5((f"api_key{api_key}methodauth.getToken{api_secret}").encode()).hexdigest()
+    url = f"{API_ROOT}?method=auth.getToken"
+    api_sig = sign_params({"api_key": api_key, "method": "auth.getToken"}, api_secret)
     params = {
             "api_key": api_key,
             "api_sig": api_sig,
             "format": "json"
             }
-    response = requests.post(url, data=params).json()
+    response = http_post(url, data=params).json()
     token = response["token"]
     return token
 
 def get_session_key(api_key, api_secret, token):
-    url = "http://ws.audioscrobbler.com/2.0/?method=auth.getSession"
-    api_sig = hashlib.md5((f"api_key{api_key}methodauth.getSessiontoken{token}{api_secret}").encode()).hexdigest()
+    url = f"{API_ROOT}?method=auth.getSession"
+    api_sig = sign_params({"api_key": api_key, "method": "auth.getSession", "token": token}, api_secret)
     params = {
             "api_key": api_key,
             "api_sig": api_sig,
             "token": token,
             "format": "json"
             }
-    response = requests.post(url, data=params).json()
+    response = http_post(url, data=params).json()
     session_key = response['session']['key']
     return session_key
 
-def get_or_generate_session_key():
+def get_or_generate_session_key(interactive=True):
+    global cached_session_key
+    if cached_session_key:
+        return cached_session_key
+    import configparser
     config = configparser.ConfigParser()
     config.read('config.ini')
-    if config.has_option('AUTH', 'SESSION_KEY'):
+    if config.has_option('AUTH', 'SESSION_KEY') and config.get('AUTH', 'SESSION_KEY') != rejected_session_key:
         session_key = config.get('AUTH', 'SESSION_KEY')
-        return session_key
+    elif not interactive:
+        return None
     else:
         token = get_request_token(api_key, api_secret)
         auth_url = f"http://www.last.fm/api/auth?api_key={api_key}&token={token}"
@@ -878,9 +2435,11 @@ def get_or_generate_session_key():
         input("Press Enter after granting permission...")
         session_key = get_session_key(api_key, api_secret, token)
         save_session_key(session_key)
-        return session_key
+    cached_session_key = session_key
+    return session_key
 
 def save_session_key(session_key):
+    import configparser
     config = configparser.ConfigParser()
     config.read('config.ini')
     if not config.has_section('AUTH'):
@@ -889,8 +2448,24 @@ def save_session_key(session_key):
     with open('config.ini', 'w') as configfile:
         config.write(configfile)
 
-def main():
+def run_command():
+    if args.build_index is not None:
+        sites = args.build_index or CHORD_SITES
+        build_artist_index(sites)
+        return
+    if args.sync_library:
+        count = sync_library(full=args.sync_library == 'full')
+        print(f"{count} loved tracks synced.")
+        return
+    if args.resolve_setlist:
+        found, missed = resolve_setlist(args.resolve_setlist, args.output, args.refresh)
+        print(f"{found} found, {missed} not found, written to {args.output}")
+        return
     try:
+        get_network()
+        load_history()
+        start_scrobble_flusher()
+        scrobble_wakeup.set()
         if args.track:
             track = search_track(args.track)
             play_track(track)
@@ -919,9 +2494,20 @@ def main():
             add_to_played_tracks(None, None, False)
             track = get_random_loved_track()
             play_track(track)
-    except pylast.NetworkError as e:
+    except pylast_error('NetworkError') as e:
         print("Network error:", str(e))
 
+def main(argv=None):
+    global args, trace_enabled
+    args = build_parser().parse_args(argv)
+    signal.signal(signal.SIGINT, signal_handler)
+    trace_enabled = bool(args.trace or args.trace_json or args.trace_metrics)
+    begin_transition(new_transition("startup"))
+    try:
+        run_command()
+    finally:
+        report_trace()
+
 if __name__ == "__main__":
     main()
 
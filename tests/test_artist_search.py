@@ -0,0 +1,111 @@
+import os
+import sys
+import string
+import tempfile
+import unittest
+
+# Runs main.py's artist lookup against the stand-in from benchmarks/:
+#     python -m unittest discover tests
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path[:0] = [os.path.join(ROOT, 'benchmarks'), ROOT]
+from standin import StandIn, Catalogue, MYTABS_PAGE_SIZE
+
+main = None
+stand_in = None
+
+def make_names(prefix, count):
+    suffixes = (a + b for a in string.ascii_lowercase for b in string.ascii_lowercase)
+    return [prefix + next(suffixes) for _ in range(count)]
+
+# Five pages under "a": "alisa" closes page 2, and the fuzzy neighbour
+# "alisa sh" opens page 3, the first one a binary search fetches.
+A_ARTISTS = make_names('ab', 2 * MYTABS_PAGE_SIZE - 1) + ['alisa', 'alisa sh'] + make_names('an', 119)
+U_ARTISTS = make_names('ub', 3 * MYTABS_PAGE_SIZE)
+
+class TestCatalogue(Catalogue):
+    def __init__(self):
+        super().__init__(artists=0)
+        self.artists = A_ARTISTS + U_ARTISTS
+        self.tracks = {artist: [f"{artist} song"] for artist in self.artists}
+        self.slugs = {artist.replace(' ', '-'): artist for artist in self.artists}
+
+    def by_mytabs_letter(self, letter):
+        artists = super().by_mytabs_letter(letter)
+        # "u" is listed out of order, as some letters on the real site are.
+        return artists[::-1] if letter == 'u' else artists
+
+def setUpModule():
+    global main, stand_in
+    stand_in = StandIn(TestCatalogue()).start()
+    os.environ.update(stand_in.root_env())
+    os.environ['SCROBBLE_DB'] = os.path.join(tempfile.mkdtemp(prefix='scrobblethatising-test-'), 'test.db')
+    os.environ.setdefault('LASTFM_API_KEY', 'test')
+    import main as main_module
+    main = main_module
+    main.args = main.build_parser().parse_args([])
+
+def tearDownModule():
+    stand_in.stop()
+
+def href(artist):
+    return f"/akkordy/{artist.replace(' ', '-')}"
+
+class MytabsSearchTest(unittest.TestCase):
+    def setUp(self):
+        main.console.quiet = True
+        with main.db_lock, main.get_db() as db:
+            for table in ('artist_index', 'artist_index_letters', 'letter_pages'):
+                db.execute(f"DELETE FROM {table}")
+        main.artist_name_indexes.clear()
+        stand_in.take_counts()
+
+    def lookup(self, artist):
+        return main.get_artist_link(artist, 'mytabs'), stand_in.take_counts().get('mytabs', 0)
+
+    def test_sorted_letter_is_bisected(self):
+        link, requests = self.lookup(A_ARTISTS[-1])
+        self.assertEqual(link, href(A_ARTISTS[-1]))
+        self.assertLessEqual(requests, 4)
+
+    def test_close_name_does_not_stop_the_search(self):
+        link, _ = self.lookup('alisa')
+        self.assertEqual(link, href('alisa'))
+
+    def test_close_name_is_returned_without_exact_one(self):
+        link, _ = self.lookup('alisa shh')
+        self.assertEqual(link, href('alisa sh'))
+
+    def test_cached_bounds_skip_fetched_pages(self):
+        self.lookup('alisa')
+        link, requests = self.lookup('abbzz')
+        self.assertIsNone(link)
+        self.assertEqual(requests, 0)
+        link, requests = self.lookup(A_ARTISTS[-1])
+        self.assertEqual(link, href(A_ARTISTS[-1]))
+        self.assertLessEqual(requests, 2)
+
+    def test_unsorted_letter_is_read_in_full(self):
+        letter, letter_url = main.get_letter_url('u', 'mytabs')
+        with self.assertRaises(main.UnsortedLetterPages):
+            main.search_mytabs_letter(U_ARTISTS[0], letter, letter_url)
+        stand_in.take_counts()
+        # One request for page 1 that gives the order away, then all three.
+        link, requests = self.lookup(U_ARTISTS[0])
+        self.assertEqual(link, href(U_ARTISTS[0]))
+        self.assertEqual(requests, 4)
+
+class NameIndexTest(unittest.TestCase):
+    def test_spelling_and_word_order_are_ignored(self):
+        index = main.NameIndex([('Виктор Цой', 1), ('The Beatles', 2), ('Кино', 3)])
+        self.assertEqual(index.best_match('цой виктор')[1:], (1, 1.0))
+        self.assertEqual(index.best_match('beatles')[1:], (2, 1.0))
+        self.assertEqual(index.best_match('Kino')[1:], (3, 1.0))
+        self.assertIsNone(index.best_match('nobody'))
+
+    def test_partial_song_names(self):
+        songs = main.NameIndex([('Кукушка (live)', 'a'), ('Группа крови', 'b')], partial=True)
+        self.assertEqual(songs.best_match('кукушка')[1], 'a')
+        self.assertEqual(songs.best_match('группа крови')[1:], ('b', 1.0))
+
+if __name__ == "__main__":
+    unittest.main()